@@ -0,0 +1,78 @@
+"""
+Coalescing of received events into worker invocation payloads.
+"""
+import time
+
+MAX_PAYLOAD_SIZE = 256 * 1024  # Lambda async invocation payload limit
+
+
+class EventBuffer:
+    """
+    Collect JSON-encoded events from several receives into a single worker
+    payload. The buffer should be flushed when it's full, i.e. holds
+    `max_events` events, when the next event would push the payload over
+    `max_bytes` or when the oldest buffered event has waited for `linger`
+    seconds.
+    """
+
+    def __init__(self, max_events, max_bytes=MAX_PAYLOAD_SIZE, linger=0):
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.linger = linger
+        self._clear()
+
+    def __len__(self):
+        return len(self.events)
+
+    def _clear(self):
+        self.events = []
+        self.entries = []
+        self.size = 2  # enclosing brackets
+        self.started = None
+
+    def fits(self, encoded):
+        """Check if an encoded event fits in the payload size limit."""
+        return self.size + _payload_size(encoded) <= self.max_bytes
+
+    def add(self, encoded, entry):
+        """Add an encoded event along with its SQS delete entry."""
+        if not self.events:
+            self.started = time.monotonic()
+        self.events.append(encoded)
+        self.entries.append(entry)
+        self.size += _payload_size(encoded)
+
+    def discard(self, entry):
+        """
+        Add the SQS delete entry of a duplicate message to be deleted along
+        with the buffered events without forwarding it to the worker.
+        """
+        self.entries.append(entry)
+
+    def full(self):
+        return len(self.events) >= self.max_events
+
+    def linger_left(self):
+        """
+        Return seconds left until the buffer should be flushed or None when
+        the buffer is empty.
+        """
+        if not self.events:
+            return None
+        return max(self.started + self.linger - time.monotonic(), 0)
+
+    def due(self):
+        return bool(self.events) and (self.full() or self.linger_left() == 0)
+
+    def flush(self):
+        """
+        Empty the buffer, return JSON array payload and SQS delete entries.
+        """
+        payload = '[' + ', '.join(self.events) + ']'
+        entries = self.entries
+        self._clear()
+        return payload, entries
+
+
+def _payload_size(encoded):
+    return len(encoded.encode('utf-8')) + 2  # ', ' separator
@@ -0,0 +1,143 @@
+"""
+Memory-capped deduplication of received messages.
+"""
+from collections import OrderedDict
+import hashlib
+import math
+import time
+
+KEYS = ['message_id', 'event_id']  # SQS message ids or event ids
+
+
+class Deduplicator:
+    """
+    Base class for deduplicators. `seen` records a key and tells if it has
+    been recorded before.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def seen(self, key):
+        if self._check_and_add(key):
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def _check_and_add(self, key):
+        raise NotImplementedError
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+
+class LRUDeduplicator(Deduplicator):
+    """
+    Remember up to `max_size` most recently seen keys, forgetting keys older
+    than `ttl` seconds.
+    """
+
+    def __init__(self, max_size, ttl=None, clock=time.monotonic):
+        super().__init__()
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self._keys = OrderedDict()  # key -> last seen, oldest first
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _check_and_add(self, key):
+        now = self.clock()
+        self._expire(now)
+        found = key in self._keys
+        self._keys[key] = now
+        self._keys.move_to_end(key)
+        if len(self._keys) > self.max_size:
+            self._keys.popitem(last=False)
+            self.evictions += 1
+        return found
+
+    def _expire(self, now):
+        if self.ttl is None:
+            return
+        while self._keys:
+            oldest, seen_at = next(iter(self._keys.items()))
+            if now - seen_at < self.ttl:
+                break
+            del self._keys[oldest]
+            self.evictions += 1
+
+
+class BloomDeduplicator(Deduplicator):
+    """
+    Remember keys in two generations of Bloom filters sized for `capacity`
+    keys at the given false positive rate. Once the current generation
+    fills up the previous one is dropped, so memory use stays fixed while the
+    most recent `capacity` keys are always remembered.
+
+    False positives cause unseen keys to be reported as duplicates.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        super().__init__()
+        self.capacity = capacity
+        self.bits = math.ceil(
+            -capacity * math.log(error_rate) / math.log(2)**2)
+        self.hashes = max(round(self.bits / capacity * math.log(2)), 1)
+        self._current = bytearray(math.ceil(self.bits / 8))
+        self._previous = bytearray(len(self._current))
+        self._current_n = 0
+        self._previous_n = 0
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    @staticmethod
+    def _contains(bits, positions):
+        return all(bits[p >> 3] & (1 << (p & 7)) for p in positions)
+
+    def _check_and_add(self, key):
+        positions = self._positions(key)
+        if self._contains(self._current, positions):
+            return True
+        found = self._contains(self._previous, positions)
+
+        if self._current_n >= self.capacity:
+            self.evictions += self._previous_n
+            self._previous, self._previous_n = self._current, self._current_n
+            self._current = bytearray(len(self._previous))
+            self._current_n = 0
+        for p in positions:
+            self._current[p >> 3] |= 1 << (p & 7)
+        self._current_n += 1
+        return found
+
+
+def create_deduplicator(mode, max_size, ttl=None, key='message_id'):
+    """
+    Create a deduplicator by mode name, either 'lru' or 'bloom', for one of
+    the KEYS. Messages duplicating an event id are deleted without being
+    forwarded, so a false positive would lose an event: event ids can't be
+    deduplicated by Bloom filters.
+    """
+    if key not in KEYS:
+        raise ValueError(f'Unknown deduplication key {key}')
+    if mode == 'bloom' and key == 'event_id':
+        raise ValueError('Bloom deduplication can drop unseen events, use '
+                         'lru mode to deduplicate by event_id')
+    if mode == 'lru':
+        return LRUDeduplicator(max_size, ttl)
+    if mode == 'bloom':
+        return BloomDeduplicator(max_size)
+    raise ValueError(f'Unknown deduplication mode {mode}')
@@ -0,0 +1,93 @@
+"""
+Visibility timeout leases for in-flight SQS messages.
+"""
+import logging
+import threading
+import time
+
+logger = logging.getLogger()
+
+SQS_BATCH_SIZE = 10  # max entries per SQS batch request
+
+
+class LeaseManager:
+    """
+    Keep received messages hidden from other pollers for as long as they're
+    being worked on. A heartbeat thread extends leases that are about to
+    expire in batches; messages that failed are released back to the queue so
+    that they can be retried right away.
+    """
+
+    def __init__(self, queue, timeout, interval=None, clock=time.monotonic):
+        self.queue = queue
+        self.timeout = timeout
+        self.interval = interval or timeout / 3
+        self.clock = clock
+        self.extended = 0
+        self.released = 0
+        self._leases = {}  # message id -> [receipt handle, expiry]
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._heartbeat = None
+
+    def __len__(self):
+        return len(self._leases)
+
+    def __enter__(self):
+        self._heartbeat = threading.Thread(target=self._run, daemon=True)
+        self._heartbeat.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stopped.set()
+        self._heartbeat.join()
+        self.release(list(self._leases))  # whatever wasn't completed
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.heartbeat()
+            except Exception:
+                logger.exception('Failed to extend message leases')
+
+    def acquire(self, msgs):
+        """Start tracking leases of freshly received messages."""
+        expiry = self.clock() + self.timeout
+        with self._lock:
+            for m in msgs:
+                self._leases[m.message_id] = [m.receipt_handle, expiry]
+
+    def complete(self, message_ids):
+        """Stop tracking leases of deleted messages."""
+        with self._lock:
+            for message_id in message_ids:
+                self._leases.pop(message_id, None)
+
+    def release(self, message_ids):
+        """Make failed messages visible in the queue again."""
+        with self._lock:
+            leases = [(message_id, self._leases.pop(message_id)[0])
+                      for message_id in message_ids
+                      if message_id in self._leases]
+        self._change_visibility(leases, 0)
+        self.released += len(leases)
+
+    def heartbeat(self):
+        """Extend leases that would expire before the next heartbeat."""
+        now = self.clock()
+        with self._lock:
+            leases = [(message_id, lease[0])
+                      for message_id, lease in self._leases.items()
+                      if lease[1] - now <= 2 * self.interval]
+            for message_id, _ in leases:
+                self._leases[message_id][1] = now + self.timeout
+        self._change_visibility(leases, self.timeout)
+        self.extended += len(leases)
+
+    def _change_visibility(self, leases, timeout):
+        for i in range(0, len(leases), SQS_BATCH_SIZE):
+            self.queue.change_message_visibility_batch(Entries=[{
+                'Id': message_id,
+                'ReceiptHandle': receipt_handle,
+                'VisibilityTimeout': timeout
+            } for message_id, receipt_handle in leases[i:i + SQS_BATCH_SIZE]])
@@ -2,52 +2,299 @@
 Analytics consumer - pull events from analytics events queue and fan out to
 worker lambdas.
 """
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import json
+import math
 import os
+from queue import Empty
+import threading
 
 import boto3
 
+from batching import EventBuffer, MAX_PAYLOAD_SIZE
+from dedup import create_deduplicator
+from lease import LeaseManager, SQS_BATCH_SIZE
+from scheduler import Scheduler
+from pipeline import StageQueue
+
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 SQS_URL = os.environ['SQS_URL']
 WORKER_LAMBDA_ARN = os.environ['WORKER_LAMBDA_ARN']
+RECEIVERS = int(os.environ.get('RECEIVERS', 1))  # concurrent SQS pollers
+# Lease received messages for this long, extended while they're in flight:
+VISIBILITY_TIMEOUT = int(os.environ.get('VISIBILITY_TIMEOUT', 30))
+PIPELINE_DEPTH = int(os.environ.get('PIPELINE_DEPTH', 2))  # batches per stage
+# Coalesce events from several receives into one worker invocation:
+BATCH_MAX_EVENTS = int(os.environ.get('BATCH_MAX_EVENTS', 500))
+BATCH_MAX_BYTES = int(os.environ.get('BATCH_MAX_BYTES', MAX_PAYLOAD_SIZE))
+BATCH_LINGER = float(os.environ.get('BATCH_LINGER', 2))  # seconds
+# Deduplicate on either SQS 'message_id' or the 'event_id' of event bodies:
+DEDUP_KEY = os.environ.get('DEDUP_KEY', 'message_id')
+# Either 'lru' or 'bloom', which is only allowed for message_id keys:
+DEDUP_MODE = os.environ.get('DEDUP_MODE', 'lru')
+DEDUP_MAX_SIZE = int(os.environ.get('DEDUP_MAX_SIZE', 100000))
+DEDUP_TTL = float(os.environ.get('DEDUP_TTL', 300))  # seconds, LRU mode only
+# Splice event strings into worker payloads instead of decoding and encoding:
+FORWARD_RAW_EVENTS = os.environ.get('FORWARD_RAW_EVENTS', 'true') == 'true'
+# Time to leave for winding down after the last round of work:
+TIME_RESERVE_MS = int(os.environ.get('TIME_RESERVE_MS', 2000))
+# Invoke an extra consumer per this many queued messages, up to a maximum:
+SCALE_OUT_THRESHOLD = int(os.environ.get('SCALE_OUT_THRESHOLD', 1000))
+SCALE_OUT_MAX = int(os.environ.get('SCALE_OUT_MAX', 0))
+# Store events into the database directly instead of invoking the worker:
+DIRECT_SINK = os.environ.get('DIRECT_SINK', 'false') == 'true'
+DB_URL = os.environ.get('DB_URL')
+TABLE_NAME = os.environ.get('TABLE_NAME')
+LOAD_METHOD = os.environ.get('LOAD_METHOD', 'values')  # see store.LOADERS
+ROLLUPS = os.environ.get('ROLLUPS', 'true') == 'true'  # see worker
 
 invoke = boto3.client('lambda').invoke
 sqs = boto3.resource('sqs').Queue(SQS_URL)
+db = None
+if DIRECT_SINK:
+    # Needs psycopg2, which fan-out mode can do without:
+    from connection import ConnectionManager
+    db = ConnectionManager(DB_URL)  # connected on first use
 
 
 def main(event, context):
-    processed = 0
-    handled_mgs_ids = set()
-
-    while context.get_remaining_time_in_millis() > 10000:
-        message_bodies = []
-        messages_to_delete = []
-        msgs = sqs.receive_messages(
-            MaxNumberOfMessages=10, VisibilityTimeout=0, WaitTimeSeconds=1)
-
-        # Deduplicate and parse message bodies:
-        for m in msgs:
-            if m.message_id in handled_mgs_ids:
-                continue
-            handled_mgs_ids.add(m.message_id)
-            message_bodies.append(json.loads(json.loads(m.body)['Message']))
-            messages_to_delete.append({
-                'Id': m.message_id,
-                'ReceiptHandle': m.receipt_handle
-            })
-
-        if not messages_to_delete:
-            break
+    dedup = create_deduplicator(DEDUP_MODE, DEDUP_MAX_SIZE, DEDUP_TTL,
+                                DEDUP_KEY)
+    scale_out(event, context)
+    processed = invocations = 0
+    received = StageQueue('receive', maxsize=PIPELINE_DEPTH)
+    dispatched = StageQueue('dispatch', maxsize=PIPELINE_DEPTH)
+    buffer = EventBuffer(BATCH_MAX_EVENTS, BATCH_MAX_BYTES, BATCH_LINGER)
+    leases = LeaseManager(sqs, VISIBILITY_TIMEOUT)
+    scheduler = Scheduler(context, TIME_RESERVE_MS)
+    stop = threading.Event()
+
+    def receive():
+        """
+        Receive message batches into the pipeline until SQS runs dry, the
+        time budget runs out or the dispatcher signals a stop.
+        """
+        try:
+            while not stop.is_set() and scheduler.can_start():
+                with scheduler.measure('receive'):
+                    msgs = sqs.receive_messages(
+                        MaxNumberOfMessages=10,
+                        VisibilityTimeout=VISIBILITY_TIMEOUT,
+                        WaitTimeSeconds=1)
+                if not msgs:
+                    break
+                leases.acquire(msgs)
+                received.put(msgs)
+        finally:
+            received.put(None)  # signal the dispatcher this receiver is done
+
+    def delete():
+        """
+        Delete dispatched messages from SQS until the dispatcher is done.
+        """
+        try:
+            while True:
+                entries = dispatched.get()
+                if entries is None:
+                    return
+                with scheduler.measure('delete'):
+                    failed = delete_messages(entries)
+                if failed:
+                    logger.warning('Failed to delete %d message(s): %s',
+                                   len(failed), sorted(failed))
+                    leases.release(failed)  # visible again to be retried
+                leases.complete(e['Id'] for e in entries)
+        except Exception:
+            stop.set()
+            while dispatched.get() is not None:
+                pass  # keep the dispatcher from blocking on a full queue
+            raise
+
+    def dispatch():
+        """
+        Invoke worker with buffered events and pass the corresponding messages
+        on to be deleted.
+        """
+        nonlocal processed, invocations
+        events_n = len(buffer)
+        payload, entries = buffer.flush()
+        if events_n:
+            with scheduler.measure('dispatch'):
+                if DIRECT_SINK:
+                    store_events(payload)
+                else:
+                    invoke(
+                        FunctionName=WORKER_LAMBDA_ARN,
+                        InvocationType='Event',
+                        Payload=payload)
+            processed += events_n
+            invocations += 1
+        dispatched.put(entries)
+
+    # Messages left unfinished are released as the lease manager exits:
+    with leases, ThreadPoolExecutor(max_workers=RECEIVERS + 1) as executor:
+        receivers = [executor.submit(receive) for _ in range(RECEIVERS)]
+        deleter = executor.submit(delete)
+        running = len(receivers)
+
+        try:
+            while running:
+                try:
+                    msgs = received.get(timeout=buffer.linger_left())
+                except Empty:
+                    dispatch()  # buffered events have lingered long enough
+                    continue
+                if msgs is None:
+                    running -= 1
+                    continue
+
+                # Deduplicate and buffer message bodies:
+                new_msgs = 0
+                for m in msgs:
+                    entry = {
+                        'Id': m.message_id,
+                        'ReceiptHandle': m.receipt_handle
+                    }
+                    raw = _unwrap_event(m.body)
+                    event = None
+                    if DEDUP_KEY == 'event_id':
+                        event = _decode_event(raw)
+                        if event is None:
+                            # Skipped by the worker anyway:
+                            logger.warning(
+                                'Invalid event object, skipping: %s', raw)
+                            buffer.discard(entry)
+                            continue
+
+                    if DEDUP_KEY == 'message_id':
+                        if dedup.seen(m.message_id):
+                            continue
+                    elif dedup.seen(event['event_id']):
+                        buffer.discard(entry)  # separate duplicate message
+                        continue
+
+                    new_msgs += 1
+                    if FORWARD_RAW_EVENTS and _is_json_object(raw):
+                        encoded = raw  # forward as is without re-encoding
+                    else:
+                        encoded = json.dumps(
+                            json.loads(raw) if event is None else event)
+                    if buffer and not buffer.fits(encoded):
+                        dispatch()
+                    buffer.add(encoded, entry)
+                    if buffer.full():
+                        dispatch()
+
+                if buffer.due():
+                    dispatch()
+                if not new_msgs:
+                    # Only already handled messages left in the queue:
+                    stop.set()
+
+            if buffer.entries:
+                dispatch()
+        finally:
+            stop.set()
+            while running:  # drain to unblock receivers after a failure
+                if received.get() is None:
+                    running -= 1
+            dispatched.put(None)
+
+        for future in receivers + [deleter]:
+            future.result()  # re-raise stage errors
+
+    logger.info(
+        'Processed %d event(s) with %d receiver(s) in %d invocation(s)',
+        processed, RECEIVERS, invocations)
+    logger.info('Extended %d and released %d message lease(s)',
+                leases.extended, leases.released)
+    logger.info(
+        'Deduplication by %(key)s: %(hits)d hit(s), %(misses)d miss(es), '
+        '%(evictions)d eviction(s)', dict(dedup.stats(), key=DEDUP_KEY))
+    for stage_queue in [received, dispatched]:
+        logger.info(
+            'Stage %(stage)s: max depth %(max_depth)d, mean depth '
+            '%(mean_depth).2f, producer stall %(producer_stall).3fs, '
+            'consumer stall %(consumer_stall).3fs',
+            dict(stage_queue.stats(), stage=stage_queue.name))
+    return {'processed': processed}
 
+
+def scale_out(event, context):
+    """
+    Invoke extra consumer instances when the queue has built up a backlog.
+    Return the number of invoked instances.
+    """
+    if SCALE_OUT_MAX <= 0 or event.get('scaled_out'):
+        return 0  # scaled out instances don't scale out further
+
+    backlog = int(
+        sqs.meta.client.get_queue_attributes(
+            QueueUrl=sqs.url, AttributeNames=['ApproximateNumberOfMessages'])
+        ['Attributes']['ApproximateNumberOfMessages'])
+    extra = min(math.ceil(backlog / SCALE_OUT_THRESHOLD) - 1, SCALE_OUT_MAX)
+    for _ in range(extra):
         invoke(
-            FunctionName=WORKER_LAMBDA_ARN,
+            FunctionName=context.invoked_function_arn,
             InvocationType='Event',
-            Payload=json.dumps(message_bodies))
-        processed += len(messages_to_delete)
-        sqs.delete_messages(Entries=messages_to_delete)
+            Payload=json.dumps({'scaled_out': True}))
 
-    logger.info('Processed %d event(s)', processed)
-    return {'processed': processed}
+    if extra > 0:
+        logger.info('Backlog of %d message(s), invoked %d extra consumer(s)',
+                    backlog, extra)
+    return max(extra, 0)
+
+
+def delete_messages(entries):
+    """
+    Delete messages in batches of up to SQS_BATCH_SIZE entries. Return the
+    ids of messages that failed to be deleted.
+    """
+    failed = set()
+    for i in range(0, len(entries), SQS_BATCH_SIZE):
+        response = sqs.delete_messages(Entries=entries[i:i + SQS_BATCH_SIZE])
+        failed.update(f['Id'] for f in response.get('Failed', []))
+    return failed
+
+
+def store_events(payload):
+    """
+    Store a payload of events the same way the worker would, over a
+    persistent database connection.
+    """
+    import store
+    db.run(store.insert, TABLE_NAME, store.to_values(json.loads(payload)),
+           LOAD_METHOD, ROLLUPS)
+
+
+def _unwrap_event(body):
+    """
+    Return event JSON from a message body. The body is either an SNS
+    notification envelope or, with raw message delivery, the event itself.
+    """
+    if '"Message"' not in body:
+        return body  # skip decoding raw events altogether
+    envelope = json.loads(body)
+    if 'Message' in envelope and 'event_id' not in envelope:
+        return envelope['Message']
+    return body
+
+
+def _decode_event(raw):
+    """Return the decoded event, or None if it lacks a string event_id."""
+    try:
+        event = json.loads(raw)
+    except ValueError:
+        return None
+    if isinstance(event, dict) and isinstance(event.get('event_id'), str):
+        return event
+    return None
+
+
+def _is_json_object(raw):
+    """Cheap sanity check before forwarding an undecoded event."""
+    raw = raw.strip()
+    return raw[:1] == '{' and raw[-1:] == '}'
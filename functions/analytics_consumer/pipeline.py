@@ -0,0 +1,52 @@
+"""
+Helpers for running the consumer as a pipeline of concurrent stages.
+"""
+from queue import Queue
+import time
+
+
+class StageQueue(Queue):
+    """
+    Bounded queue between two pipeline stages. Keeps track of queue depth and
+    of the time producers and consumers spend blocked on the queue.
+    """
+
+    def __init__(self, name, maxsize):
+        super().__init__(maxsize)
+        self.name = name
+        self.max_depth = 0
+        self.put_stall = 0.0
+        self.get_stall = 0.0
+        self._depth_sum = 0
+        self._depth_samples = 0
+
+    def put(self, item, block=True, timeout=None):
+        start = time.perf_counter()
+        super().put(item, block, timeout)
+        with self.mutex:
+            self.put_stall += time.perf_counter() - start
+            self._sample_depth()
+
+    def get(self, block=True, timeout=None):
+        start = time.perf_counter()
+        try:
+            return super().get(block, timeout)
+        finally:
+            with self.mutex:
+                self.get_stall += time.perf_counter() - start
+
+    def _sample_depth(self):
+        depth = self._qsize()
+        self.max_depth = max(self.max_depth, depth)
+        self._depth_sum += depth
+        self._depth_samples += 1
+
+    def stats(self):
+        """Return a summary of queue depth and stall times."""
+        with self.mutex:
+            return {
+                'max_depth': self.max_depth,
+                'mean_depth': self._depth_sum / max(self._depth_samples, 1),
+                'producer_stall': self.put_stall,
+                'consumer_stall': self.get_stall
+            }
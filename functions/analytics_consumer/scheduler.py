@@ -0,0 +1,61 @@
+"""
+Time budget scheduling for the consumer loop.
+"""
+from collections import deque
+from contextlib import contextmanager
+import math
+import threading
+
+
+class Scheduler:
+    """
+    Decide whether there's still time to start another round of work within
+    the Lambda time budget. Latencies are tracked per pipeline stage over a
+    moving window, and work is started only if a round is predicted to finish
+    - at the given latency percentile - with `reserve_ms` to spare for
+    winding down.
+
+    Time is measured with the Lambda context's remaining time.
+    """
+
+    def __init__(self, context, reserve_ms, percentile=95, window=100,
+                 initial_ms=2000):
+        self.context = context
+        self.reserve_ms = reserve_ms
+        self.percentile = percentile
+        self.window = window
+        self.initial_ms = initial_ms
+        self._latencies = {}  # stage -> recent latencies in ms
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def measure(self, stage):
+        """Record latency of the wrapped block under a stage name."""
+        started = self.context.get_remaining_time_in_millis()
+        yield
+        self.record(stage,
+                    started - self.context.get_remaining_time_in_millis())
+
+    def record(self, stage, latency_ms):
+        with self._lock:
+            if stage not in self._latencies:
+                self._latencies[stage] = deque(maxlen=self.window)
+            self._latencies[stage].append(latency_ms)
+
+    def predict(self):
+        """Return predicted duration of a round of work through all stages."""
+        with self._lock:
+            if not self._latencies:
+                return self.initial_ms
+            return sum(
+                _percentile(latencies, self.percentile)
+                for latencies in self._latencies.values())
+
+    def can_start(self):
+        remaining = self.context.get_remaining_time_in_millis()
+        return remaining - self.reserve_ms >= self.predict()
+
+
+def _percentile(values, percentile):
+    values = sorted(values)
+    return values[max(math.ceil(percentile / 100 * len(values)) - 1, 0)]
@@ -0,0 +1,71 @@
+"""
+Consumer benchmarks, run with `inv benchmark`. They print their results
+rather than asserting on them, as timings depend on the machine.
+"""
+import json
+import time
+from uuid import uuid4
+
+from connection import ConnectionManager
+from fixtures import MockSQSMessage
+from test_main import handler, queue
+
+
+def test_forward_raw_events_cpu_time(mocker, queue, handler, event):
+    n = 10000
+    e = event()
+    e['meta'] = {f'key_{i}': f'value_{i}' for i in range(20)}
+    msgs = [MockSQSMessage(dict(e, event_id=str(uuid4()))) for _ in range(n)]
+    mock_sqs = mocker.patch('main.sqs')
+    mocker.patch('main.invoke')
+
+    for forward_raw in [False, True]:
+        mock_sqs.receive_messages.side_effect = [
+            msgs[i:i + 10] for i in range(0, n, 10)
+        ] + [[]]
+        mocker.patch('main.FORWARD_RAW_EVENTS', forward_raw)
+        mocker.patch('main.DEDUP_MAX_SIZE', n)
+        start = time.process_time()
+        assert handler() == {'processed': n}
+        print(f'CPU time per {n} events, forward raw events {forward_raw}: '
+              f'{time.process_time() - start:.3f}s')
+
+
+def test_direct_sink_throughput(mocker, queue, handler, event, db):
+    """
+    Compare direct sink against fanning out to worker invocations, emulated
+    by storing events over a separate connection after an invoke round trip.
+    """
+    import psycopg2
+    import store
+    db_url, table = db
+    n = 5000
+    invoke_latency = 0.02
+    mock_sqs = mocker.patch('main.sqs')
+    mocker.patch.multiple(
+        'main', TABLE_NAME=table, db=ConnectionManager(db_url),
+        DEDUP_MAX_SIZE=2 * n)
+    worker_conn = psycopg2.connect(db_url)
+
+    def invoke_worker(Payload, **kwargs):
+        time.sleep(invoke_latency)
+        store.insert(worker_conn, table, store.to_values(json.loads(Payload)))
+
+    mocker.patch('main.invoke').side_effect = invoke_worker
+
+    for direct_sink in [False, True]:
+        events = [event() for _ in range(n)]
+        mock_sqs.receive_messages.side_effect = [
+            [MockSQSMessage(e) for e in events[i:i + 10]]
+            for i in range(0, n, 10)
+        ] + [[]]
+        mocker.patch('main.DIRECT_SINK', direct_sink)
+        start = time.perf_counter()
+        assert handler() == {'processed': n}
+        print(f'Direct sink {direct_sink}: '
+              f'{n / (time.perf_counter() - start):.0f} events/sec')
+
+    worker_conn.close()
+    with psycopg2.connect(db_url) as conn, conn.cursor() as cur:
+        cur.execute(f'SELECT count(*) FROM {table}')
+        assert cur.fetchone()[0] == 2 * n
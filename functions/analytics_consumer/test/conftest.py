@@ -3,5 +3,7 @@ import sys
 
 here = os.path.dirname(os.path.realpath(__file__))
 sys.path.insert(0, os.path.join(here, '..', '..', '..', 'test_utils'))
+# Modules shared with the worker, see SHARED_MODULES in tasks.py:
+sys.path.append(os.path.join(here, '..', '..', 'analytics_worker'))
 
-from fixtures import event, lambda_context
+from fixtures import db, event, lambda_context, schema
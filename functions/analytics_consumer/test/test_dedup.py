@@ -0,0 +1,63 @@
+import pytest
+
+from dedup import BloomDeduplicator, LRUDeduplicator, create_deduplicator
+
+
+def test_lru_counters():
+    dedup = LRUDeduplicator(max_size=10)
+    assert [dedup.seen(k) for k in 'abab'] == [False, False, True, True]
+    assert dedup.stats() == {'hits': 2, 'misses': 2, 'evictions': 0}
+
+
+def test_lru_evict_least_recently_seen():
+    dedup = LRUDeduplicator(max_size=2)
+    dedup.seen('a')
+    dedup.seen('b')
+    dedup.seen('a')  # refresh 'a' so that 'b' gets evicted next
+    dedup.seen('c')
+    assert len(dedup) == 2
+    assert dedup.evictions == 1
+    assert dedup.seen('a')
+    assert not dedup.seen('b')
+
+
+def test_lru_evict_expired():
+    now = [0]
+    dedup = LRUDeduplicator(max_size=10, ttl=60, clock=lambda: now[0])
+    dedup.seen('a')
+    now[0] = 30
+    dedup.seen('b')
+    now[0] = 61
+    assert not dedup.seen('a')
+    assert dedup.seen('b')
+    assert dedup.evictions == 1
+
+
+def test_bloom_remember_recent_keys():
+    capacity = 1000
+    dedup = BloomDeduplicator(capacity, error_rate=0.001)
+    keys = [str(i) for i in range(capacity * 3)]
+    size = len(dedup._current) + len(dedup._previous)
+
+    false_positives = sum(dedup.seen(k) for k in keys)
+    assert false_positives < 10
+    assert all(dedup.seen(k) for k in keys[-capacity:])
+    assert dedup.evictions >= capacity
+    assert len(dedup._current) + len(dedup._previous) == size
+
+
+def test_create_deduplicator():
+    assert isinstance(create_deduplicator('lru', 10), LRUDeduplicator)
+    assert isinstance(create_deduplicator('bloom', 10), BloomDeduplicator)
+    with pytest.raises(ValueError):
+        create_deduplicator('foo', 10)
+
+
+def test_create_deduplicator_keys():
+    dedup = create_deduplicator('lru', 10, key='event_id')
+    assert isinstance(dedup, LRUDeduplicator)
+    with pytest.raises(ValueError, match='Unknown deduplication key'):
+        create_deduplicator('lru', 10, key='foo')
+    # False positives would delete events that were never forwarded:
+    with pytest.raises(ValueError, match='Bloom'):
+        create_deduplicator('bloom', 10, key='event_id')
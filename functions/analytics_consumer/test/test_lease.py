@@ -0,0 +1,49 @@
+from fixtures import MockSQSMessage
+from lease import LeaseManager
+
+
+def changed_visibility(mock_queue):
+    return [
+        (e['Id'], e['VisibilityTimeout'])
+        for c in mock_queue.change_message_visibility_batch.call_args_list
+        for e in c[1]['Entries']
+    ]
+
+
+def test_extend_expiring_leases(mocker):
+    now = [0]
+    mock_queue = mocker.Mock()
+    leases = LeaseManager(mock_queue, 30, interval=10, clock=lambda: now[0])
+    old = [MockSQSMessage() for _ in range(15)]
+    leases.acquire(old)
+    now[0] = 5
+    new = [MockSQSMessage()]
+    leases.acquire(new)
+
+    now[0] = 10
+    leases.heartbeat()
+    assert changed_visibility(mock_queue) == [(m.message_id, 30) for m in old]
+    assert mock_queue.change_message_visibility_batch.call_count == 2
+    assert leases.extended == len(old)
+
+    mock_queue.reset_mock()
+    now[0] = 15
+    leases.heartbeat()
+    assert changed_visibility(mock_queue) == [(new[0].message_id, 30)]
+
+
+def test_release_and_complete(mocker):
+    mock_queue = mocker.Mock()
+    msgs = [MockSQSMessage() for _ in range(3)]
+
+    with LeaseManager(mock_queue, 30) as leases:
+        leases.acquire(msgs)
+        leases.complete([msgs[0].message_id])
+        leases.release([msgs[1].message_id])
+        assert changed_visibility(mock_queue) == [(msgs[1].message_id, 0)]
+        assert len(leases) == 1
+
+    # Unfinished leases get released on exit:
+    assert changed_visibility(mock_queue)[1:] == [(msgs[2].message_id, 0)]
+    assert leases.released == 2
+    assert len(leases) == 0
@@ -1,11 +1,19 @@
 import json
+import logging
 import os
+import subprocess
+import sys
+import threading
+import time
 from uuid import uuid4
 
 import boto3
 from moto import mock_lambda, mock_sqs
 import pytest
 
+from connection import ConnectionManager
+from fixtures import MockSQSMessage, SimulatedClock
+
 os.environ['WORKER_LAMBDA_ARN'] = 'test-worker-lambda-arn'
 
 
@@ -80,6 +88,7 @@ def test_multiple_receive_batches(mocker, handler, queue, event):
             })
         } for e in batch])
 
+    mocker.patch('main.BATCH_MAX_EVENTS', batch_size)
     mock_invoke = mocker.patch('main.invoke')
     assert handler() == {'processed': n}
     calls = [
@@ -98,12 +107,6 @@ def test_deduplicate(mocker, handler, queue, event):
     events = [event() for _ in range(7)]
 
     # Mock a SQS queue with 2 duplicates among event messages:
-    class MockSQSMessage:
-        def __init__(self, event):
-            self.body = json.dumps({'Message': json.dumps(event)})
-            self.message_id = event['event_id']
-            self.receipt_handle = str(uuid4())
-
     msgs = [MockSQSMessage(e) for e in events]
     msgs.insert(2, MockSQSMessage(events[1]))
     msgs.insert(6, MockSQSMessage(events[3]))
@@ -116,3 +119,383 @@ def test_deduplicate(mocker, handler, queue, event):
         FunctionName=os.environ['WORKER_LAMBDA_ARN'],
         InvocationType='Event',
         Payload=json.dumps(events))
+
+
+def test_receivers_poll_concurrently(mocker, queue, handler, event):
+    import main
+    n = 100
+    latency = 0.3  # simulated SQS round trip
+    receive_messages = main.sqs.receive_messages
+    lock = threading.Lock()
+    polling = peak = 0
+
+    def slow_receive(**kwargs):
+        nonlocal polling, peak
+        with lock:
+            polling += 1
+            peak = max(peak, polling)
+        try:
+            time.sleep(latency)
+            return receive_messages(**kwargs)
+        finally:
+            with lock:
+                polling -= 1
+
+    mocker.patch.object(main.sqs, 'receive_messages', side_effect=slow_receive)
+    mock_invoke = mocker.patch('main.invoke')
+
+    peaks = {}
+    for receivers in [1, 4]:
+        for i in range(0, n, 10):
+            queue.send_messages(Entries=[{
+                'Id': str(j),
+                'MessageBody': json.dumps({
+                    'Message': json.dumps(event())
+                })
+            } for j in range(10)])
+
+        mocker.patch('main.RECEIVERS', receivers)
+        peak = 0
+        start = time.perf_counter()
+        assert handler() == {'processed': n}
+        peaks[receivers] = peak
+        print(f'{receivers} receiver(s): {peak} concurrent receive(s), '
+              f'{n / (time.perf_counter() - start):.0f} msgs/sec')
+
+    invoked = [json.loads(c[1]['Payload']) for c in mock_invoke.call_args_list]
+    assert sum(len(events) for events in invoked) == 2 * n
+    assert peaks == {1: 1, 4: 4}
+
+
+def test_pipeline_overlaps_stages(mocker, queue, handler, event, caplog):
+    batches = [[MockSQSMessage(event()) for _ in range(10)] for _ in range(5)]
+    # Receiving the third batch, invoking the worker with the second and
+    # deleting the first have to be in progress at the same time to pass:
+    overlap = threading.Barrier(3, timeout=5)
+    calls = {'receive': 0, 'invoke': 0, 'delete': 0}
+
+    def stage(name, meet_at, result=None):
+        def call(**kwargs):
+            calls[name] += 1
+            if calls[name] == meet_at:
+                overlap.wait()
+            return result() if callable(result) else result
+        return call
+
+    mock_sqs = mocker.patch('main.sqs')
+    mock_sqs.receive_messages.side_effect = stage(
+        'receive', 3, iter(batches + [[]]).__next__)
+    mock_sqs.delete_messages.side_effect = stage('delete', 1, {})
+    mocker.patch('main.invoke').side_effect = stage('invoke', 2)
+    mocker.patch('main.BATCH_MAX_EVENTS', 10)  # a dispatch per receive
+
+    with caplog.at_level(logging.INFO):
+        assert handler() == {'processed': 50}
+    assert calls == {'receive': 6, 'invoke': 5, 'delete': 5}
+    assert 'Stage receive: max depth' in caplog.text
+    assert 'Stage dispatch: max depth' in caplog.text
+
+
+@pytest.mark.parametrize('max_events, expected_invocations', [(10, 100),
+                                                              (500, 2)])
+def test_coalesce_invocations(mocker, queue, handler, event, max_events,
+                              expected_invocations):
+    n = 1000
+    batches = [[MockSQSMessage(event()) for _ in range(10)]
+               for _ in range(n // 10)]
+    mocker.patch('main.sqs').receive_messages.side_effect = batches + [[]]
+    mocker.patch('main.BATCH_MAX_EVENTS', max_events)
+    mock_invoke = mocker.patch('main.invoke')
+
+    assert handler() == {'processed': n}
+    print(f'Invocations per {n} events with up to {max_events} events per '
+          f'invocation: {mock_invoke.call_count}')
+    assert mock_invoke.call_count == expected_invocations
+
+
+def test_coalesce_up_to_payload_limit(mocker, queue, handler, event):
+    events = [event() for _ in range(30)]
+    for e in events:
+        e['meta'] = {'padding': 'x' * 900}
+    mocker.patch('main.sqs').receive_messages.side_effect = [
+        [MockSQSMessage(e) for e in events[i:i + 10]]
+        for i in range(0, len(events), 10)
+    ] + [[]]
+    mocker.patch('main.BATCH_MAX_BYTES', 10000)
+    mock_invoke = mocker.patch('main.invoke')
+
+    assert handler() == {'processed': len(events)}
+    payloads = [c[1]['Payload'] for c in mock_invoke.call_args_list]
+    assert all(len(p) <= 10000 for p in payloads)
+    assert sum((json.loads(p) for p in payloads), []) == events
+    assert len(payloads) == 4
+
+
+def test_coalesce_flush_after_linger(mocker, queue, handler, event):
+    batches = [[MockSQSMessage(event())] for _ in range(3)]
+
+    def receive(**kwargs):
+        time.sleep(0.1)
+        return batches.pop(0) if batches else []
+
+    mocker.patch('main.sqs').receive_messages.side_effect = receive
+    mocker.patch('main.BATCH_LINGER', 0.15)
+    mock_invoke = mocker.patch('main.invoke')
+
+    assert handler() == {'processed': 3}
+    assert [len(json.loads(c[1]['Payload']))
+            for c in mock_invoke.call_args_list] == [2, 1]
+
+
+def test_deduplicate_by_event_id(mocker, queue, handler, event):
+    events = [event() for _ in range(3)]
+    msgs = [MockSQSMessage(e) for e in events]
+
+    # Same event published twice results in two separate messages:
+    duplicate = MockSQSMessage(events[0])
+    duplicate.message_id = str(uuid4())
+    msgs.append(duplicate)
+
+    mock_sqs = mocker.patch('main.sqs')
+    mock_sqs.receive_messages.side_effect = [msgs, []]
+    mocker.patch('main.DEDUP_KEY', 'event_id')
+    mock_invoke = mocker.patch('main.invoke')
+
+    assert handler() == {'processed': len(events)}
+    mock_invoke.assert_called_once_with(
+        FunctionName=os.environ['WORKER_LAMBDA_ARN'],
+        InvocationType='Event',
+        Payload=json.dumps(events))
+    deleted = [
+        e for c in mock_sqs.delete_messages.call_args_list
+        for e in c[1]['Entries']
+    ]
+    assert [e['Id'] for e in deleted] == [m.message_id for m in msgs]
+
+
+def test_skip_invalid_events_by_event_id(mocker, queue, handler, event):
+    events = [event() for _ in range(2)]
+    invalid = [MockSQSMessage(event()) for _ in range(4)]
+    for m, body in zip(invalid, ['{"event_type": "x"}', '{"event_id": 1}',
+                                 '[1, 2]', 'not json']):
+        m.body = json.dumps({'Message': body})
+    msgs = [MockSQSMessage(events[0])] + invalid + [MockSQSMessage(events[1])]
+
+    mock_sqs = mocker.patch('main.sqs')
+    mock_sqs.receive_messages.side_effect = [msgs, []]
+    mocker.patch('main.DEDUP_KEY', 'event_id')
+    mock_invoke = mocker.patch('main.invoke')
+
+    assert handler() == {'processed': len(events)}
+    mock_invoke.assert_called_once_with(
+        FunctionName=os.environ['WORKER_LAMBDA_ARN'],
+        InvocationType='Event',
+        Payload=json.dumps(events))
+    deleted = [
+        e for c in mock_sqs.delete_messages.call_args_list
+        for e in c[1]['Entries']
+    ]
+    assert sorted(e['Id'] for e in deleted) == sorted(
+        m.message_id for m in msgs)
+    mock_sqs.change_message_visibility_batch.assert_not_called()
+
+
+@pytest.mark.parametrize('key, mode', [('foo', 'lru'),
+                                       ('event_id', 'bloom')])
+def test_invalid_dedup_config(mocker, queue, handler, key, mode):
+    mock_sqs = mocker.patch('main.sqs')
+    mocker.patch.multiple('main', DEDUP_KEY=key, DEDUP_MODE=mode)
+    with pytest.raises(ValueError):
+        handler()
+    mock_sqs.receive_messages.assert_not_called()
+
+
+def test_delete_in_sqs_batches(mocker, queue, handler, event):
+    import main
+    msgs = [MockSQSMessage(event()) for _ in range(95)]
+    mock_sqs = mocker.patch('main.sqs')
+    mock_sqs.receive_messages.side_effect = [
+        msgs[i:i + 10] for i in range(0, len(msgs), 10)
+    ] + [[]]
+    # SQS fails to delete one message of the second batch:
+    mock_sqs.delete_messages.side_effect = lambda Entries: {
+        'Successful': [{'Id': e['Id']} for e in Entries],
+        'Failed': [{'Id': e['Id'], 'Code': 'ReceiptHandleIsInvalid'}
+                   for e in Entries if e['Id'] == msgs[15].message_id]
+    }
+    release = mocker.spy(main.LeaseManager, 'release')
+    mocker.patch('main.invoke')
+
+    assert handler() == {'processed': len(msgs)}
+    batches = [
+        c[1]['Entries'] for c in mock_sqs.delete_messages.call_args_list
+    ]
+    assert [len(b) for b in batches] == [10] * 9 + [5]
+    assert [e['Id'] for b in batches for e in b] == [
+        m.message_id for m in msgs]
+    assert release.call_args_list[0][0][1] == {msgs[15].message_id}
+    released = mock_sqs.change_message_visibility_batch.call_args[1]
+    assert released['Entries'] == [{
+        'Id': msgs[15].message_id,
+        'ReceiptHandle': msgs[15].receipt_handle,
+        'VisibilityTimeout': 0
+    }]
+
+
+@pytest.mark.parametrize('forward_raw', [True, False])
+def test_forward_raw_events(mocker, queue, handler, event, forward_raw):
+    e1, e2 = event(), event()
+    msgs = [MockSQSMessage(e1), MockSQSMessage(e2)]
+    # Forwarded events keep the formatting they were published in:
+    msgs[1].body = json.dumps({'Message': json.dumps(e2, indent=2)})
+
+    mocker.patch('main.sqs').receive_messages.side_effect = [msgs, []]
+    mocker.patch('main.FORWARD_RAW_EVENTS', forward_raw)
+    mock_invoke = mocker.patch('main.invoke')
+
+    assert handler() == {'processed': 2}
+    payload = mock_invoke.call_args[1]['Payload']
+    assert json.loads(payload) == [e1, e2]
+    assert (json.dumps(e2, indent=2) in payload) == forward_raw
+
+
+@pytest.mark.parametrize('forward_raw', [True, False])
+def test_forward_raw_events_skip_decoding(mocker, queue, handler, event,
+                                          forward_raw):
+    events = [event() for _ in range(4)]
+    msgs = [MockSQSMessage(e) for e in events]
+    for m, e in zip(msgs[2:], events[2:]):
+        m.body = json.dumps(e)  # raw message delivery
+
+    mocker.patch('main.sqs').receive_messages.side_effect = [msgs, []]
+    mocker.patch('main.FORWARD_RAW_EVENTS', forward_raw)
+    mock_invoke = mocker.patch('main.invoke')
+    loads = mocker.spy(json, 'loads')
+
+    assert handler() == {'processed': len(events)}
+    # Only SNS envelopes are decoded when forwarding raw events:
+    assert loads.call_count == (2 if forward_raw else 2 + len(events))
+    assert json.loads(mock_invoke.call_args[1]['Payload']) == events
+
+
+def test_raw_message_delivery(mocker, queue, handler, event):
+    e1, e2, e3 = event(), event(), event()
+    e3['meta'] = {'Message': 'not an envelope'}
+    queue.send_message(MessageBody=json.dumps({'Message': json.dumps(e1)}))
+    queue.send_message(MessageBody=json.dumps(e2))
+    queue.send_message(MessageBody=json.dumps(e3))
+
+    mock_invoke = mocker.patch('main.invoke')
+    assert handler() == {'processed': 3}
+    mock_invoke.assert_called_once_with(
+        FunctionName=os.environ['WORKER_LAMBDA_ARN'],
+        InvocationType='Event',
+        Payload=json.dumps([e1, e2, e3]))
+
+
+def test_release_leases_on_failure(mocker, queue, handler, event):
+    for _ in range(3):
+        queue.send_message(
+            MessageBody=json.dumps({
+                'Message': json.dumps(event())
+            }))
+
+    mocker.patch('main.invoke').side_effect = Exception('invoke failed')
+    with pytest.raises(Exception, match='invoke failed'):
+        handler()
+
+    # Messages are visible for others to retry right away:
+    assert len(queue.receive_messages(MaxNumberOfMessages=10)) == 3
+
+
+def test_adaptive_time_budget(mocker, queue, lambda_context, event):
+    import main
+
+    clock = SimulatedClock()
+    context = type(lambda_context)(30, clock)
+
+    def receive(**kwargs):
+        clock.now += 4
+        return [MockSQSMessage(event()) for _ in range(10)]
+
+    mocker.patch('main.sqs').receive_messages.side_effect = receive
+    mocker.patch('main.TIME_RESERVE_MS', 1000)
+    mocker.patch('main.invoke')
+
+    # A fixed 10 second margin would stop after 5 receives:
+    assert main.main({}, context) == {'processed': 70}
+    assert context.get_remaining_time_in_millis() >= 1000
+
+
+@pytest.mark.parametrize('backlog, expected_extra', [(0, 0), (20, 0), (50, 2),
+                                                     (200, 4)])
+def test_scale_out(mocker, queue, lambda_context, event, backlog,
+                   expected_extra):
+    import main
+    for i in range(0, backlog, 10):
+        queue.send_messages(Entries=[{
+            'Id': str(j),
+            'MessageBody': json.dumps({
+                'Message': json.dumps(event())
+            })
+        } for j in range(10)])
+
+    mocker.patch('main.SCALE_OUT_THRESHOLD', 20)
+    mocker.patch('main.SCALE_OUT_MAX', 4)
+    mock_invoke = mocker.patch('main.invoke')
+
+    assert main.scale_out({}, lambda_context) == expected_extra
+    assert mock_invoke.call_args_list == [
+        mocker.call(
+            FunctionName=lambda_context.invoked_function_arn,
+            InvocationType='Event',
+            Payload=json.dumps({'scaled_out': True}))
+    ] * expected_extra
+
+    # Scaled out instances don't scale out further:
+    assert main.scale_out({'scaled_out': True}, lambda_context) == 0
+
+
+def test_fan_out_without_database_modules(queue):
+    # Without psycopg2 and the modules shared with the worker, e.g. when
+    # installing psycopg2 failed during the build:
+    code = "import sys; sys.modules['psycopg2'] = None; import main"
+    subprocess.run([sys.executable, '-c', code], check=True,
+                   cwd=os.path.dirname(os.path.dirname(__file__)))
+
+
+def test_direct_sink(mocker, queue, handler, event, db):
+    import psycopg2
+    db_url, table = db
+    events = [event() for _ in range(25)]
+    mocker.patch('main.sqs').receive_messages.side_effect = [
+        [MockSQSMessage(e) for e in events[i:i + 10]]
+        for i in range(0, len(events), 10)
+    ] + [[]]
+    mocker.patch.multiple(
+        'main', DIRECT_SINK=True, TABLE_NAME=table,
+        db=ConnectionManager(db_url))
+    mock_invoke = mocker.patch('main.invoke')
+
+    assert handler() == {'processed': len(events)}
+    mock_invoke.assert_not_called()
+    with psycopg2.connect(db_url) as conn, conn.cursor() as cur:
+        cur.execute(f'SELECT event_id FROM {table} ORDER BY id')
+        stored = [r[0] for r in cur.fetchall()]
+    assert stored == [e['event_id'] for e in events]
+
+
+@pytest.mark.parametrize('method', ['values', 'unnest', 'prepared'])
+def test_direct_sink_invalid_events(mocker, queue, handler, event, db,
+                                    method):
+    db_url, table = db
+    events = [{'event_id': event()['event_id']} for _ in range(3)]
+    mocker.patch('main.sqs').receive_messages.side_effect = [
+        [MockSQSMessage(e) for e in events], []
+    ]
+    mocker.patch.multiple(
+        'main', DIRECT_SINK=True, TABLE_NAME=table, LOAD_METHOD=method,
+        db=ConnectionManager(db_url))
+
+    # Invalid events are skipped, leaving nothing to store:
+    assert handler() == {'processed': len(events)}
@@ -0,0 +1,22 @@
+import threading
+
+from pipeline import StageQueue
+
+
+def test_stage_queue_stats():
+    q = StageQueue('test', maxsize=2)
+    for i in range(2):
+        q.put(i)
+    assert q.stats()['max_depth'] == 2
+    assert q.stats()['mean_depth'] == 1.5
+
+    # Block the producer on a full queue until a consumer frees a slot:
+    threading.Timer(0.1, q.get).start()
+    q.put(2)
+    assert q.stats()['producer_stall'] >= 0.1
+
+    for _ in range(2):
+        q.get()
+    threading.Timer(0.1, q.put, [3]).start()
+    assert q.get() == 3
+    assert q.stats()['consumer_stall'] >= 0.1
@@ -0,0 +1,41 @@
+from fixtures import SimulatedClock
+from scheduler import Scheduler
+
+
+def test_initial_prediction(lambda_context):
+    context = type(lambda_context)(10, SimulatedClock())
+    scheduler = Scheduler(context, reserve_ms=1000, initial_ms=2000)
+    assert scheduler.predict() == 2000
+    assert scheduler.can_start()
+
+
+def test_predict_from_latency_percentile(lambda_context):
+    clock = SimulatedClock()
+    context = type(lambda_context)(10, clock)
+    scheduler = Scheduler(context, reserve_ms=1000, percentile=90, window=10)
+
+    for latency in [0.1] * 9 + [2.0]:
+        with scheduler.measure('receive'):
+            clock.sleep(latency)
+    assert scheduler.predict() == 100
+    scheduler.record('receive', 500)  # oldest sample drops out of the window
+    assert scheduler.predict() == 500
+
+    scheduler.record('delete', 300)
+    assert scheduler.predict() == 800
+
+
+def test_start_only_if_predicted_to_finish(lambda_context):
+    clock = SimulatedClock()
+    context = type(lambda_context)(10, clock)
+    scheduler = Scheduler(context, reserve_ms=1000)
+
+    rounds = 0
+    while scheduler.can_start():
+        with scheduler.measure('receive'):
+            clock.sleep(2)
+        rounds += 1
+
+    # Rounds starting at 0, 2, 4 and 6 seconds fit in the budget:
+    assert rounds == 4
+    assert context.get_remaining_time_in_millis() >= 1000
@@ -0,0 +1,86 @@
+"""
+Encoder for Postgres binary COPY format, see "Binary Format" in
+https://www.postgresql.org/docs/current/static/sql-copy.html
+
+Supports the varchar, timestamp and jsonb column types of the events table.
+Timestamps are only parsed in ISO 8601 format with up to microsecond
+precision; encoders raise ValueError for anything else.
+"""
+from datetime import datetime, timedelta
+import re
+import struct
+
+INT16 = struct.Struct('!h')
+INT32 = struct.Struct('!i')
+INT64 = struct.Struct('!q')
+
+HEADER = b'PGCOPY\n\xff\r\n\x00' + INT32.pack(0) + INT32.pack(0)
+TRAILER = INT16.pack(-1)
+NULL = INT32.pack(-1)
+PG_EPOCH = datetime(2000, 1, 1)
+JSONB_VERSION = b'\x01'
+
+# Time zone is ignored when casting to timestamp without time zone:
+TIMESTAMP_PATTERN = re.compile(
+    r'\s*(\d{4})-(\d\d)-(\d\d)'
+    r'(?:[T ](\d\d):(\d\d)(?::(\d\d)(?:\.(\d{1,6}))?)?)?'
+    r'\s*(?:Z|[+-]\d\d(?::?\d\d)?)?\s*$')
+
+# Field encoders append field data prefixed with its length to a buffer:
+
+
+def encode_varchar(buffer, value):
+    data = str(value).encode('utf-8')
+    buffer += INT32.pack(len(data))
+    buffer += data
+
+
+def encode_timestamp(buffer, value):
+    """Encode timestamp as microseconds since the Postgres epoch."""
+    if not isinstance(value, datetime):
+        match = TIMESTAMP_PATTERN.match(value)
+        if not match:
+            raise ValueError(f'Unsupported timestamp format: {value}')
+        year, month, day, hour, minute, second, fraction = match.groups()
+        # Raises ValueError for fields out of range, e.g. hour 24:
+        value = datetime(
+            int(year), int(month), int(day), int(hour or 0),
+            int(minute or 0), int(second or 0),
+            int((fraction or '0').ljust(6, '0')))
+    buffer += INT32.pack(8)
+    buffer += INT64.pack((value - PG_EPOCH) // timedelta(microseconds=1))
+
+
+def encode_jsonb(buffer, value):
+    """Encode JSON text in jsonb binary format version 1."""
+    data = value.encode('utf-8')
+    buffer += INT32.pack(len(data) + 1)
+    buffer += JSONB_VERSION
+    buffer += data
+
+
+ENCODERS = {
+    'varchar': encode_varchar,
+    'timestamp': encode_timestamp,
+    'jsonb': encode_jsonb
+}
+
+
+def encode(rows, column_types):
+    """
+    Encode rows of values into a bytearray in binary COPY format, with
+    `column_types` naming the ENCODERS to use for each column. Fields are
+    encoded straight into the buffer, which grows as needed.
+    """
+    encoders = [ENCODERS[t] for t in column_types]
+    field_count = INT16.pack(len(encoders))
+    buffer = bytearray(HEADER)
+    for row in rows:
+        buffer += field_count
+        for encoder, v in zip(encoders, row):
+            if v is None:
+                buffer += NULL
+            else:
+                encoder(buffer, v)
+    buffer += TRAILER
+    return buffer
@@ -0,0 +1,79 @@
+"""
+Persistent database connection management for warm Lambda containers.
+"""
+import logging
+import time
+
+import psycopg2
+from psycopg2.extras import LoggingConnection
+
+logger = logging.getLogger()
+
+# TCP keepalive settings, so that dropped connections are noticed:
+KEEPALIVES = {
+    'keepalives': 1,
+    'keepalives_idle': 30,
+    'keepalives_interval': 10,
+    'keepalives_count': 3
+}
+
+
+class ConnectionManager:
+    """
+    Database connection that is opened on first use and reused across warm
+    invocations. A connection that has been idle for longer than
+    `idle_check` seconds is checked to still be alive before reuse, and
+    re-established if the server has dropped it in the meanwhile.
+    """
+
+    def __init__(self, dsn, idle_check=60, clock=time.monotonic):
+        self.dsn = dsn
+        self.idle_check = idle_check
+        self.clock = clock
+        self.conn = None
+        self.connects = 0
+        self._last_used = None
+
+    def get(self):
+        """Return a live connection."""
+        if self.conn is None or self.conn.closed:
+            self._connect()
+        elif (self.clock() - self._last_used > self.idle_check
+              and not self._alive()):
+            logger.warning('Database connection lost while idle, reconnecting')
+            self._connect()
+        self._last_used = self.clock()
+        return self.conn
+
+    def run(self, func, *args):
+        """
+        Call `func` with a live connection and the given arguments. Retry once
+        on a fresh connection if the connection turns out to be broken, so
+        `func` should be safe to retry.
+        """
+        try:
+            return func(self.get(), *args)
+        except (psycopg2.InterfaceError, psycopg2.OperationalError):
+            if self.conn is None or not self.conn.closed:
+                raise  # couldn't connect, or unrelated to the connection
+            logger.warning('Database connection lost, reconnecting')
+            return func(self.get(), *args)
+        finally:
+            self._last_used = self.clock()
+
+    def _alive(self):
+        try:
+            with self.conn.cursor() as cur:
+                cur.execute('SELECT 1')
+            self.conn.rollback()
+            return True
+        except (psycopg2.InterfaceError, psycopg2.OperationalError):
+            return False
+
+    def _connect(self):
+        if self.conn is not None and not self.conn.closed:
+            self.conn.close()
+        self.conn = psycopg2.connect(
+            self.dsn, connection_factory=LoggingConnection, **KEEPALIVES)
+        self.conn.initialize(logger)
+        self.connects += 1
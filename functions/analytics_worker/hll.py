@@ -0,0 +1,76 @@
+"""
+HyperLogLog sketches for approximate distinct counts, see Flajolet et al.,
+"HyperLogLog: the analysis of a near-optimal cardinality estimation
+algorithm", with the small range correction of the original paper.
+"""
+import hashlib
+import math
+
+PRECISION = 14  # 2^14 one byte registers, standard error 0.81%
+
+
+class HyperLogLog:
+    """
+    Sketch of a set of strings, stored as a byte per register so that it can
+    be kept in a bytea column. Sketches of the same precision are merged by
+    taking the maximum of each register.
+    """
+
+    def __init__(self, precision=PRECISION, registers=None):
+        self.precision = precision
+        self.m = 1 << precision
+        self.registers = (bytearray(registers)
+                          if registers is not None else bytearray(self.m))
+        if len(self.registers) != self.m:
+            raise ValueError(
+                f'Expected {self.m} registers, got {len(self.registers)}')
+
+    @classmethod
+    def from_bytes(cls, data):
+        precision = len(data).bit_length() - 1
+        return cls(precision, data)
+
+    def to_bytes(self):
+        return bytes(self.registers)
+
+    def add(self, value):
+        digest = hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest()
+        h = int.from_bytes(digest, 'big')
+        index = h >> (64 - self.precision)
+        rest_bits = 64 - self.precision
+        rest = h & ((1 << rest_bits) - 1)
+        rank = rest_bits - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, values):
+        for value in values:
+            self.add(value)
+
+    def merge(self, other):
+        """Merge another sketch into this one."""
+        if other.precision != self.precision:
+            raise ValueError('Cannot merge sketches of different precision')
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def count(self):
+        """Return the estimated number of distinct values added."""
+        m = self.m
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / math.fsum(2.0**-r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)  # linear counting
+        return round(estimate)
+
+    def standard_error(self):
+        return 1.04 / math.sqrt(self.m)
+
+
+def merge_all(sketches, precision=PRECISION):
+    """Return the union of the given sketches."""
+    merged = HyperLogLog(precision)
+    for sketch in sketches:
+        merged.merge(sketch)
+    return merged
@@ -1,48 +1,35 @@
 """
-Analytics consumer - pull events from analytics events queue and fan out to
-worker lambdas.
+Analytics worker - store analytics events into the database.
 """
 import logging
-import json
 import os
 
-from psycopg2.extras import execute_values, LoggingConnection
+from connection import ConnectionManager
+from store import insert, statement_cache, to_values
 
 DB_URL = os.environ['DB_URL']
 TABLE_NAME = os.environ['TABLE_NAME']
+LOAD_METHOD = os.environ.get('LOAD_METHOD', 'values')  # see store.LOADERS
+# Keep the per minute and hour rollup tables up to date with the events:
+ROLLUPS = os.environ.get('ROLLUPS', 'true') == 'true'
+# Check connections idle for longer than this to still be alive before use:
+DB_IDLE_CHECK = float(os.environ.get('DB_IDLE_CHECK', 60))  # seconds
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)  # set to DEBUG to log SQL queries
-conn = LoggingConnection(DB_URL)
-conn.initialize(logger)
-
-EVENT_KEYS = [
-    'event_id', 'event_timestamp', 'event_type', 'event_version', 'app_title',
-    'app_version', 'user_id', 'user_name', 'meta', 'token_payload'
-]
-JSON_FIELDS = ['meta', 'token_payload']
-INSERT_QUERY = f"""
-    INSERT INTO {TABLE_NAME} ({', '.join(EVENT_KEYS)}) VALUES %s
-    ON CONFLICT (event_id) DO NOTHING
-"""
+db = ConnectionManager(DB_URL, DB_IDLE_CHECK)
 
 
 def main(event, context):
     logger.info('Received %d event items', len(event))
-    values = []
-    for e in event:
-        for json_key in JSON_FIELDS:
-            e[json_key] = json.dumps(e.get(json_key, {}))
-        try:
-            values.append(tuple(e[key] for key in EVENT_KEYS))
-        except KeyError:
-            logger.warn('Invalid event object, skipping: %s', e)
+    values = to_values(event)
 
     if values:
-        with conn:
-            with conn.cursor() as cur:
-                execute_values(cur, INSERT_QUERY, values)
+        db.run(insert, TABLE_NAME, values, LOAD_METHOD, ROLLUPS)
 
     logger.info('Processed %d event(s), skipped %d', len(values),
                 len(event) - len(values))
-    return {'processed': len(values)}
+    result = {'processed': len(values)}
+    if LOAD_METHOD == 'prepared':
+        result['statement_cache_hit_rate'] = statement_cache.hit_rate()
+    return result
@@ -0,0 +1,313 @@
+"""
+Storing analytics events into the database. Shared by the worker and the
+consumer's direct sink mode.
+"""
+from collections import Counter
+import io
+import json
+import logging
+import re
+
+from psycopg2.extras import execute_values
+
+import binary_copy
+from hll import HyperLogLog
+
+logger = logging.getLogger()
+
+EVENT_KEYS = [
+    'event_id', 'event_timestamp', 'event_type', 'event_version', 'app_title',
+    'app_version', 'user_id', 'user_name', 'meta', 'token_payload'
+]
+COLUMN_TYPES = ['varchar', 'timestamp'] + ['varchar'] * 6 + ['jsonb'] * 2
+JSON_FIELDS = ['meta', 'token_payload']
+COLUMNS = ', '.join(EVENT_KEYS)
+# Unique keys of partitioned tables must include the partition key:
+UNIQUE_KEY = 'event_id, event_timestamp'
+# Columns of newly inserted rows returned by the loaders for the rollups:
+INSERTED_COLUMNS = 'event_timestamp, event_type, app_title, user_id'
+PAGE_SIZE = 100  # rows per multi-row VALUES statement
+STAGING_TABLE = 'events_staging'
+COPY_ESCAPES = str.maketrans({
+    '\\': '\\\\',
+    '\n': '\\n',
+    '\r': '\\r',
+    '\t': '\\t'
+})
+ARRAY_ESCAPES = str.maketrans({'\\': '\\\\', '"': '\\"'})
+
+# Rollup tables are named <table>_per_<period>, with a function truncating
+# timestamps to the start of their period:
+ROLLUP_PERIODS = {
+    'minute': lambda t: t.replace(second=0, microsecond=0),
+    'hour': lambda t: t.replace(minute=0, second=0, microsecond=0)
+}
+
+
+def insert_query(table):
+    return f"""
+    INSERT INTO {table} ({COLUMNS}) VALUES %s
+    ON CONFLICT ({UNIQUE_KEY}) DO NOTHING
+    RETURNING {INSERTED_COLUMNS}
+"""
+
+
+def unnest_query(table):
+    casts = ', '.join(f'%s::{column_type}[]' for column_type in COLUMN_TYPES)
+    return f"""
+    INSERT INTO {table} ({COLUMNS}) SELECT * FROM unnest({casts})
+    ON CONFLICT ({UNIQUE_KEY}) DO NOTHING
+    RETURNING {INSERTED_COLUMNS}
+"""
+
+
+def to_values(events):
+    """
+    Convert event objects into value tuples in EVENT_KEYS order, skipping
+    invalid events.
+    """
+    values = []
+    for e in events:
+        for json_key in JSON_FIELDS:
+            e[json_key] = json.dumps(e.get(json_key, {}))
+        try:
+            values.append(tuple(e[key] for key in EVENT_KEYS))
+        except KeyError:
+            logger.warning('Invalid event object, skipping: %s', e)
+    return values
+
+
+def insert(conn, table, values, method='values', rollups=True):
+    """
+    Insert value tuples in a single transaction using one of the LOADERS,
+    updating the rollup tables and user sketches in the same transaction
+    unless disabled.
+    Return the number of inserted, i.e. non-duplicate, rows.
+
+    Loaders return the INSERTED_COLUMNS of the rows they inserted.
+    """
+    if not values:
+        return 0  # array based loaders can't infer columns from no rows
+    with conn:
+        with conn.cursor() as cur:
+            inserted = LOADERS[method](cur, table, values)
+            if rollups:
+                update_rollups(cur, table, inserted)
+                update_sketches(cur, table, inserted)
+    return len(inserted)
+
+
+def update_rollups(cur, table, inserted):
+    """
+    Add counts of inserted rows per period, event type and app to the
+    rollup tables. Counters are upserted in a fixed order so that
+    concurrent transactions can't deadlock on them.
+    """
+    for period, truncate in ROLLUP_PERIODS.items():
+        counts = Counter((truncate(timestamp), event_type, app_title)
+                         for timestamp, event_type, app_title, _ in inserted)
+        if not counts:
+            continue
+        execute_values(
+            cur, f"""
+            INSERT INTO {table}_per_{period} AS r
+            (bucket, event_type, app_title, count) VALUES %s
+            ON CONFLICT (bucket, event_type, app_title)
+            DO UPDATE SET count = r.count + excluded.count
+        """, sorted(key + (n, ) for key, n in counts.items()),
+            page_size=len(counts))
+
+
+def update_sketches(cur, table, inserted):
+    """
+    Add user ids of inserted rows to the HyperLogLog sketches of distinct
+    users per day and app. Each call inserts partial sketches of its own
+    rows, which are merged when queried, so that concurrent transactions
+    don't serialize on shared sketch rows.
+    """
+    sketches = {}
+    for timestamp, _, app_title, user_id in inserted:
+        key = (timestamp.date(), app_title)
+        if key not in sketches:
+            sketches[key] = HyperLogLog()
+        sketches[key].add(user_id)
+    if not sketches:
+        return
+
+    execute_values(
+        cur, f"""
+        INSERT INTO {table}_users_per_day (day, app_title, sketch) VALUES %s
+    """, [key + (sketch.to_bytes(), ) for key, sketch in sketches.items()],
+        page_size=len(sketches))
+
+
+def compact_sketches(conn, table):
+    """
+    Merge the partial sketches of each day and app into a single one.
+    Sketches inserted while compacting are left for the next run, as they
+    aren't visible to the deleting transaction. Return the number of
+    sketches removed.
+    """
+    with conn:
+        with conn.cursor() as cur:
+            cur.execute(f"""
+                DELETE FROM {table}_users_per_day
+                WHERE (day, app_title) IN (
+                  SELECT day, app_title FROM {table}_users_per_day
+                  GROUP BY day, app_title HAVING count(*) > 1
+                )
+                RETURNING day, app_title, sketch
+            """)
+            merged = {}
+            for day, app_title, sketch in cur:
+                sketch = HyperLogLog.from_bytes(sketch)
+                if (day, app_title) in merged:
+                    merged[day, app_title].merge(sketch)
+                else:
+                    merged[day, app_title] = sketch
+            removed = cur.rowcount - len(merged)
+            if merged:
+                execute_values(
+                    cur, f"""
+                    INSERT INTO {table}_users_per_day (day, app_title, sketch)
+                    VALUES %s
+                """, [key + (merged[key].to_bytes(), )
+                      for key in sorted(merged)],
+                    page_size=len(merged))
+    return removed
+
+
+def insert_values(cur, table, values):
+    """Insert rows in pages of multi-row VALUES lists."""
+    inserted = []
+    for i in range(0, len(values), PAGE_SIZE):
+        page = values[i:i + PAGE_SIZE]
+        execute_values(cur, insert_query(table), page, page_size=len(page))
+        inserted.extend(cur.fetchall())
+    return inserted
+
+
+def insert_unnest(cur, table, values):
+    """
+    Insert rows with a single array parameter per column. Statement text
+    stays the same regardless of the number of rows.
+    """
+    cur.execute(unnest_query(table), to_arrays(values))
+    return cur.fetchall()
+
+
+def to_arrays(values):
+    """Convert value tuples into array literals, one per column."""
+    return [
+        '{' + ','.join('NULL' if v is None else
+                       '"' + str(v).translate(ARRAY_ESCAPES) + '"'
+                       for v in column) + '}' for column in zip(*values)
+    ]
+
+
+def insert_prepared(cur, table, values):
+    """
+    Like insert_unnest, but executing a server-side prepared statement that
+    is cached across warm invocations.
+    """
+    return statement_cache.execute(cur, table, to_arrays(values))
+
+
+class StatementCache:
+    """
+    Keep track of insert statements prepared on the server. Statements are
+    prepared per table on first use and again whenever the connection has
+    been re-established, as prepared statements only live as long as the
+    database session.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._backend_pid = None
+        self._prepared = set()
+
+    def hit_rate(self):
+        return self.hits / max(self.hits + self.misses, 1)
+
+    def execute(self, cur, table, arrays):
+        backend_pid = cur.connection.get_backend_pid()
+        if backend_pid != self._backend_pid:
+            self._backend_pid = backend_pid
+            self._prepared.clear()
+
+        name = 'insert_' + re.sub(r'\W', '_', table)
+        if name in self._prepared:
+            self.hits += 1
+        else:
+            self.misses += 1
+            params = ', '.join(f'${i + 1}' for i in range(len(COLUMN_TYPES)))
+            cur.execute(f"""
+                PREPARE {name} ({', '.join(t + '[]' for t in COLUMN_TYPES)}) AS
+                INSERT INTO {table} ({COLUMNS}) SELECT * FROM unnest({params})
+                ON CONFLICT ({UNIQUE_KEY}) DO NOTHING
+                RETURNING {INSERTED_COLUMNS}
+            """)
+            self._prepared.add(name)
+
+        cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(arrays))})",
+                    arrays)
+        return cur.fetchall()
+
+
+statement_cache = StatementCache()  # for the module-level connections
+
+
+def insert_copy(cur, table, values):
+    """
+    Stream rows into a temporary staging table with COPY and move them over
+    to the events table from there, ignoring duplicates.
+    """
+    return _copy_to_staging(cur, table, _text_copy_buffer(values), 'text')
+
+
+def insert_binary_copy(cur, table, values):
+    """
+    Like insert_copy, but in binary COPY format so that timestamps and JSON
+    skip text escaping and parsing on the server. Falls back to text COPY
+    for values the encoder doesn't support, e.g. timestamps in formats other
+    than ISO 8601, leaving them for the server to parse.
+    """
+    try:
+        buffer = binary_copy.encode(values, COLUMN_TYPES)
+    except ValueError as e:
+        logger.warning('Falling back to text COPY: %s', e)
+        return insert_copy(cur, table, values)
+    return _copy_to_staging(cur, table, io.BytesIO(buffer), 'binary')
+
+
+def _copy_to_staging(cur, table, buffer, copy_format):
+    cur.execute(f"""
+        CREATE TEMP TABLE IF NOT EXISTS {STAGING_TABLE} ON COMMIT DELETE ROWS
+        AS SELECT {COLUMNS} FROM {table} WITH NO DATA
+    """)
+    cur.copy_expert(
+        f'COPY {STAGING_TABLE} ({COLUMNS}) FROM STDIN '
+        f'WITH (FORMAT {copy_format})', buffer)
+    cur.execute(f"""
+        INSERT INTO {table} ({COLUMNS}) SELECT {COLUMNS} FROM {STAGING_TABLE}
+        ON CONFLICT ({UNIQUE_KEY}) DO NOTHING
+        RETURNING {INSERTED_COLUMNS}
+    """)
+    return cur.fetchall()
+
+
+def _text_copy_buffer(values):
+    """Return a file object of rows in COPY text format."""
+    return io.StringIO(''.join(
+        '\t'.join('\\N' if v is None else str(v).translate(COPY_ESCAPES)
+                  for v in row) + '\n' for row in values))
+
+
+LOADERS = {
+    'values': insert_values,
+    'unnest': insert_unnest,
+    'prepared': insert_prepared,
+    'copy': insert_copy,
+    'binary_copy': insert_binary_copy
+}
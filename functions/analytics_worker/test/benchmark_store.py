@@ -0,0 +1,24 @@
+"""
+Worker benchmarks, run with `inv benchmark`. They print their results
+rather than asserting on them, as timings depend on the machine.
+"""
+import time
+
+import pytest
+
+import store
+from test_store import conn
+
+
+@pytest.mark.parametrize('n', [10, 1000, 100000])
+def test_loader_throughput(conn, db, event, n):
+    _, table = db
+    values = store.to_values(event() for _ in range(n))
+
+    for method in store.LOADERS:
+        with conn, conn.cursor() as cur:
+            cur.execute(f'TRUNCATE {table}')
+        start = time.perf_counter()
+        assert store.insert(conn, table, values, method) == n
+        print(f'{n} rows with {method}: '
+              f'{n / (time.perf_counter() - start):.0f} rows/sec')
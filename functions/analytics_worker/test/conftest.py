@@ -4,4 +4,4 @@ import sys
 here = os.path.dirname(os.path.realpath(__file__))
 sys.path.insert(0, os.path.join(here, '..', '..', '..', 'test_utils'))
 
-from fixtures import event, lambda_context
+from fixtures import db, event, lambda_context, schema, terminate
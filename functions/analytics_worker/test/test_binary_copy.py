@@ -0,0 +1,55 @@
+from datetime import datetime
+import struct
+import tracemalloc
+
+import pytest
+
+import binary_copy
+
+
+def test_encode_rows():
+    buffer = binary_copy.encode([('a', '2000-01-01T00:00:01Z', '{}'),
+                                 ('ä', None, '[]')],
+                                ['varchar', 'timestamp', 'jsonb'])
+    assert bytes(buffer) == (
+        binary_copy.HEADER +
+        struct.pack('!hi', 3, 1) + b'a' +
+        struct.pack('!iq', 8, 1000000) +
+        struct.pack('!i', 3) + b'\x01{}' +
+        struct.pack('!hi', 3, 2) + 'ä'.encode('utf-8') +
+        struct.pack('!i', -1) +
+        struct.pack('!i', 3) + b'\x01[]' +
+        binary_copy.TRAILER)
+
+
+def test_encode_timestamp():
+    def encode(value):
+        buffer = bytearray()
+        binary_copy.encode_timestamp(buffer, value)
+        return bytes(buffer)
+
+    def decode(value):
+        length, micros = struct.unpack('!iq', encode(value))
+        assert length == 8
+        return micros
+
+    assert decode('2000-01-01') == 0
+    assert decode('1999-12-31T23:59:59.5') == -500000
+    assert encode(datetime(2018, 1, 30, 12)) == \
+        encode('2018-01-30T12:00:00.000+02:00')
+
+    # Left to the server, e.g. 24:00:00 is valid there:
+    for value in ['yesterday', '2018-02-30', '2018-01-30T24:00:00',
+                  '2018-01-30T12:75:00', '2018-01-30T12:00:60']:
+        with pytest.raises(ValueError):
+            encode(value)
+
+
+def test_encode_memory():
+    rows = [(str(i), '2018-01-30T12:34:56.789Z', '{"padding": "%s"}' % (
+        'x' * 100)) for i in range(10000)]
+    tracemalloc.start()
+    buffer = binary_copy.encode(rows, ['varchar', 'timestamp', 'jsonb'])
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    assert peak < 1.5 * len(buffer)
@@ -0,0 +1,68 @@
+import pytest
+
+from connection import ConnectionManager
+from fixtures import SimulatedClock
+
+
+def select_one(conn):
+    with conn, conn.cursor() as cur:
+        cur.execute('SELECT 1')
+        return cur.fetchone()[0]
+
+
+def test_connect_lazily_with_keepalives(db):
+    manager = ConnectionManager(db[0])
+    assert manager.conn is None
+
+    conn = manager.get()
+    assert conn.get_dsn_parameters()['keepalives'] == '1'
+    assert manager.get() is conn
+    assert manager.connects == 1
+
+
+def test_reconnect_after_idle(db, terminate):
+    clock = SimulatedClock()
+    manager = ConnectionManager(db[0], idle_check=60, clock=clock)
+    conn = manager.get()
+
+    clock.now = 30
+    assert manager.get() is conn  # no liveness check while recently used
+
+    terminate(conn)
+    clock.now = 100
+    assert manager.run(select_one) == 1
+    assert manager.conn is not conn
+    assert manager.connects == 2
+
+
+def test_retry_on_dropped_connection(db, terminate):
+    manager = ConnectionManager(db[0], idle_check=60)
+    conn = manager.get()
+
+    terminate(conn)
+    assert manager.run(select_one) == 1
+    assert manager.conn is not conn
+    assert manager.connects == 2
+
+
+def test_dont_retry_on_other_errors(db):
+    import psycopg2
+    manager = ConnectionManager(db[0])
+
+    def fail(conn):
+        with conn, conn.cursor() as cur:
+            cur.execute('SELECT 1 / 0')
+
+    with pytest.raises(psycopg2.DataError):
+        manager.run(fail)
+    assert manager.connects == 1
+
+
+def test_raise_connect_errors():
+    import psycopg2
+    manager = ConnectionManager('postgresql://user@/db?host=/nonexistent')
+    calls = []
+
+    with pytest.raises(psycopg2.OperationalError):
+        manager.run(calls.append)
+    assert calls == [] and manager.conn is None
@@ -0,0 +1,52 @@
+import uuid
+
+import pytest
+
+from hll import HyperLogLog, merge_all
+
+
+def user_ids(n):
+    return [str(uuid.uuid4()) for _ in range(n)]
+
+
+@pytest.mark.parametrize('n', [0, 10, 1000, 10000, 100000])
+def test_count_accuracy(n):
+    sketch = HyperLogLog()
+    sketch.update(user_ids(n))
+    error = abs(sketch.count() - n) / max(n, 1)
+    print(f'{n} distinct: estimated {sketch.count()}, error {error:.4f}')
+    assert error <= 3 * sketch.standard_error()
+
+
+def test_duplicates_dont_count():
+    sketch = HyperLogLog()
+    ids = user_ids(1000)
+    for _ in range(5):
+        sketch.update(ids)
+    assert abs(sketch.count() - 1000) <= 30
+
+
+def test_merge_overlapping_sketches():
+    ids = user_ids(30000)
+    days = [HyperLogLog() for _ in range(3)]
+    for i, day in enumerate(days):
+        day.update(ids[i * 10000:i * 10000 + 20000])  # overlapping ranges
+
+    union = HyperLogLog()
+    union.update(ids)
+    merged = merge_all(days)
+    assert merged.registers == union.registers
+    assert abs(merged.count() - 30000) / 30000 <= 3 * merged.standard_error()
+
+
+def test_bytes_round_trip():
+    sketch = HyperLogLog(precision=10)
+    sketch.update(user_ids(100))
+    data = sketch.to_bytes()
+    assert len(data) == 1024
+    restored = HyperLogLog.from_bytes(memoryview(data))
+    assert restored.precision == 10
+    assert restored.count() == sketch.count()
+
+    with pytest.raises(ValueError):
+        HyperLogLog().merge(restored)
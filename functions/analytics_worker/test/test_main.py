@@ -9,20 +9,20 @@ os.environ['TABLE_NAME'] = 'test_schema.test_table'
 
 @pytest.fixture
 def handler(mocker, lambda_context):
-    mocker.patch('psycopg2.extras.LoggingConnection')
+    mocker.patch('psycopg2.connect')
     import main
     return lambda event: main.main(event, lambda_context)
 
 
 def test_dont_store_when_no_events(mocker, handler):
-    mock_execute_values = mocker.patch('main.execute_values')
+    mock_execute_values = mocker.patch('store.execute_values')
     assert handler([]) == {'processed': 0}
     mock_execute_values.assert_not_called()
 
 
 def test_skip_events_with_missing_keys(mocker, event, handler):
     events = [{}, event(), {'event_id': 'invalid_event'}]
-    mock_execute_values = mocker.patch('main.execute_values')
+    mock_execute_values = mocker.patch('store.execute_values')
     assert handler(events) == {'processed': 1}
     mock_execute_values.assert_called_once
     values = mock_execute_values.call_args[0][2]
@@ -31,7 +31,7 @@ def test_skip_events_with_missing_keys(mocker, event, handler):
 
 def test_store_events(mocker, event, handler):
     events = [event() for _ in range(3)]
-    mock_execute_values = mocker.patch('main.execute_values')
+    mock_execute_values = mocker.patch('store.execute_values')
     assert handler(events) == {'processed': len(events)}
     assert mock_execute_values.call_count == 1
 
@@ -41,3 +41,12 @@ def test_store_events(mocker, event, handler):
     for event_index in range(len(events)):
         for key_index, key in enumerate(keys):
             assert values[event_index][key_index] == events[event_index][key]
+
+
+def test_return_statement_cache_hit_rate(mocker, event, handler):
+    mocker.patch('main.LOAD_METHOD', 'prepared')
+    mocker.patch('main.statement_cache.hit_rate', return_value=0.75)
+    assert handler([event()]) == {
+        'processed': 1,
+        'statement_cache_hit_rate': 0.75
+    }
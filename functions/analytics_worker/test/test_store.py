@@ -0,0 +1,275 @@
+from datetime import date
+import re
+
+from psycopg2.extras import execute_values
+import pytest
+
+from hll import HyperLogLog, merge_all
+import store
+
+
+def stored_events(conn, table):
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            SELECT {store.COLUMNS} FROM {table} ORDER BY event_timestamp
+        """)
+        return cur.fetchall()
+
+
+@pytest.fixture
+def conn(db):
+    import psycopg2
+    conn = psycopg2.connect(db[0])
+    yield conn
+    conn.close()
+
+
+@pytest.mark.parametrize('method', store.LOADERS)
+def test_loaders_store_same_rows(conn, db, event, method):
+    _, table = db
+    events = [event() for _ in range(5)]
+    events[0]['user_name'] = 'tab\tnewline\nbackslash\\ quote\' " {a,b}'
+    events[2]['app_title'] = 'NULL'
+    events[1]['meta'] = {'nested': {'list': [1, None, 'ä\\n']}}
+    reference_table = table + '_reference'
+    with conn, conn.cursor() as cur:
+        cur.execute(f"""
+            CREATE TABLE {reference_table} (LIKE {table} INCLUDING ALL)
+        """)
+
+    values = store.to_values(events)
+    store.insert(conn, reference_table, values, 'values', rollups=False)
+    # With duplicates:
+    assert store.insert(conn, table, values + values[:2], method) == 5
+    assert stored_events(conn, table) == stored_events(conn, reference_table)
+    assert len(stored_events(conn, table)) == len(events)
+
+
+@pytest.mark.parametrize('method', store.LOADERS)
+def test_loaders_skip_empty_values(conn, db, method):
+    _, table = db
+    assert store.insert(conn, table, [], method) == 0
+    with conn.cursor() as cur:
+        cur.execute(f'SELECT count(*) FROM {table}')
+        assert cur.fetchone()[0] == 0
+
+
+@pytest.mark.parametrize('method', store.LOADERS)
+def test_rollups_count_inserted_events(conn, db, event, method):
+    _, table = db
+    events = [event() for _ in range(6)]
+    for e, (timestamp, app_title) in zip(events, [
+        ('2018-01-30T12:34:01Z', 'a'),
+        ('2018-01-30T12:34:59Z', 'a'),
+        ('2018-01-30T12:34:30Z', 'b'),
+        ('2018-01-30T12:35:00Z', 'a'),
+        ('2018-01-30T13:00:00Z', 'a'),
+        ('2018-01-30T13:59:59Z', 'a'),
+    ]):
+        e['event_timestamp'] = timestamp
+        e['app_title'] = app_title
+    values = store.to_values(events)
+
+    store.insert(conn, table, values[:3], method)
+    store.insert(conn, table, values, method)  # first three are duplicates
+
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            SELECT bucket::text, app_title, count FROM {table}_per_minute
+            ORDER BY bucket, app_title
+        """)
+        assert cur.fetchall() == [
+            ('2018-01-30 12:34:00', 'a', 2),
+            ('2018-01-30 12:34:00', 'b', 1),
+            ('2018-01-30 12:35:00', 'a', 1),
+            ('2018-01-30 13:00:00', 'a', 1),
+            ('2018-01-30 13:59:00', 'a', 1),
+        ]
+        cur.execute(f"""
+            SELECT bucket::text, app_title, count FROM {table}_per_hour
+            ORDER BY bucket, app_title
+        """)
+        assert cur.fetchall() == [
+            ('2018-01-30 12:00:00', 'a', 3),
+            ('2018-01-30 12:00:00', 'b', 1),
+            ('2018-01-30 13:00:00', 'a', 2),
+        ]
+
+
+@pytest.mark.parametrize('method', ['values', 'binary_copy'])
+def test_user_sketches_match_exact_counts(conn, db, event, method):
+    _, table = db
+    users = [f'user-{i}' for i in range(3000)]
+    events = [event() for _ in range(6000)]
+    for i, e in enumerate(events):
+        e['event_timestamp'] = f'2018-01-{1 + i % 3:02d}T12:00:00Z'
+        e['app_title'] = 'ab'[i % 2]
+        e['user_id'] = users[i * 7 % len(users)]
+    values = store.to_values(events)
+
+    for i in range(0, len(values), 1000):  # partial sketch per insert
+        store.insert(conn, table, values[i:i + 1000], method)
+
+    def sketches():
+        with conn.cursor() as cur:
+            cur.execute(f"""
+                SELECT app_title, sketch FROM {table}_users_per_day
+            """)
+            by_app = {}
+            for app_title, sketch in cur.fetchall():
+                by_app.setdefault(app_title, []).append(
+                    HyperLogLog.from_bytes(sketch))
+            return by_app
+
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            SELECT app_title, count(DISTINCT user_id) FROM {table}
+            GROUP BY app_title
+        """)
+        exact = dict(cur.fetchall())
+
+    partial = sketches()
+    assert {app: len(s) for app, s in partial.items()} == {'a': 18, 'b': 18}
+    assert store.compact_sketches(conn, table) == 30
+    assert store.compact_sketches(conn, table) == 0
+    compacted = sketches()
+    for app_title, n in exact.items():
+        assert len(compacted[app_title]) == 3
+        merged = merge_all(compacted[app_title])
+        assert merged.count() == merge_all(partial[app_title]).count()
+        assert abs(merged.count() - n) / n <= 3 * merged.standard_error()
+
+
+def test_concurrent_sketch_updates_dont_block(conn, db, event):
+    import psycopg2
+    db_url, table = db
+    events = [event() for _ in range(2)]
+    for e in events:
+        e['event_timestamp'] = '2018-01-01T12:00:00Z'
+    values = store.to_values(events)
+
+    other = psycopg2.connect(db_url)
+    try:
+        with other.cursor() as cur:  # transaction left open
+            inserted = store.LOADERS['values'](cur, table, values[:1])
+            store.update_sketches(cur, table, inserted)
+
+        with conn.cursor() as cur:
+            cur.execute("SET statement_timeout = '1s'")
+        store.insert(conn, table, values[1:])
+        other.commit()
+    finally:
+        other.close()
+
+    with conn.cursor() as cur:
+        cur.execute(f'SELECT count(*) FROM {table}_users_per_day')
+        assert cur.fetchone()[0] == 2
+
+
+def test_binary_copy_timestamps(conn, db, event):
+    _, table = db
+    timestamps = [
+        '2018-01-30T12:34:56.789012Z', '2018-01-30T12:34:56.7Z',
+        '2018-01-30 12:34:56', '2018-01-30T12:34', '2018-01-30',
+        '1999-12-31T23:59:59.999999+02:00', '2100-02-28T00:00:00-0130',
+        # Left for the server to parse:
+        '2018-01-30T12:34:56.1234565', 'Jan 30 2018 12:34', '2018-01-30T24:00'
+    ]
+    events = [event() for _ in timestamps]
+    for e, timestamp in zip(events, timestamps):
+        e['event_timestamp'] = timestamp
+    values = store.to_values(events)
+
+    store.insert(conn, table, values, 'binary_copy')
+    with conn.cursor() as cur:
+        for (event_id, timestamp, *_) in values:
+            cur.execute(
+                f"""
+                SELECT event_timestamp = %s::timestamp FROM {table}
+                WHERE event_id = %s
+            """, [timestamp, event_id])
+            assert cur.fetchone() == (True, )
+
+
+@pytest.mark.parametrize('n', [10, 1000])
+def test_unnest_statement_size_and_planning(conn, db, event, n):
+    _, table = db
+    values = store.to_values(event() for _ in range(n))
+
+    with conn.cursor() as cur:
+        execute_values(cur, 'EXPLAIN (SUMMARY) ' + store.insert_query(table),
+                       values, page_size=n)
+        values_sql = cur.query
+        values_plan = cur.fetchall()[-1][0]
+
+        arrays = store.to_arrays(values)
+        cur.execute('EXPLAIN (SUMMARY) ' + store.unnest_query(table), arrays)
+        unnest_sql = cur.query
+        unnest_plan = cur.fetchall()[-1][0]
+    conn.rollback()
+
+    print(f'{n} rows with values: {len(values_sql)} bytes, {values_plan}')
+    print(f'{n} rows with unnest: {len(unnest_sql)} bytes, {unnest_plan}')
+    if n >= 1000:
+        assert planning_ms(unnest_plan) < planning_ms(values_plan)
+
+
+def planning_ms(summary):
+    return float(re.search(r'Planning Time: ([\d.]+) ms', summary).group(1))
+
+
+def test_prepared_statement_cache(mocker, db, event):
+    import psycopg2
+    db_url, table = db
+    cache = mocker.patch.object(store, 'statement_cache',
+                                store.StatementCache())
+
+    conn = psycopg2.connect(db_url)
+    for _ in range(3):
+        store.insert(conn, table, store.to_values([event()]), 'prepared')
+    assert (cache.hits, cache.misses) == (2, 1)
+
+    # Statement is prepared again after reconnecting:
+    conn.close()
+    conn = psycopg2.connect(db_url)
+    for _ in range(2):
+        store.insert(conn, table, store.to_values([event()]), 'prepared')
+    assert (cache.hits, cache.misses) == (3, 2)
+    assert cache.hit_rate() == 0.6
+
+    assert len(stored_events(conn, table)) == 5
+    conn.close()
+
+
+def test_partition_routing_and_pruning(conn, db, event):
+    import migrate
+    _, table = db
+    assert migrate.create_partitions(conn, table, date(2018, 1, 15),
+                                     date(2018, 2, 1)) == [
+        table + '_y2018m01', table + '_y2018m02'
+    ]
+    assert not conn.autocommit
+
+    events = [event() for _ in range(3)]
+    timestamps = ['2018-01-15', '2018-02-15', '1970-01-01']  # last too old
+    for e, timestamp in zip(events, timestamps):
+        e['event_timestamp'] = timestamp
+    store.insert(conn, table, store.to_values(events), 'copy')
+
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            SELECT tableoid::regclass::text FROM {table}
+            ORDER BY event_timestamp
+        """)
+        assert [r[0] for r in cur.fetchall()] == [
+            table + '_default', table + '_y2018m01', table + '_y2018m02'
+        ]
+
+        cur.execute(f"""
+            EXPLAIN SELECT count(*) FROM {table}
+            WHERE event_timestamp >= '2018-01-10'
+            AND event_timestamp < '2018-01-20'
+        """)
+        plan = '\n'.join(r[0] for r in cur.fetchall())
+    assert 'events_y2018m01' in plan
+    assert 'events_y2018m02' not in plan and 'events_default' not in plan
@@ -8,9 +8,10 @@ resource "aws_sqs_queue" "events" {
 }
 
 resource "aws_sns_topic_subscription" "on_event_created" {
-  topic_arn = "${var.event_created_topic_arn}"
-  protocol  = "sqs"
-  endpoint  = "${aws_sqs_queue.events.arn}"
+  topic_arn            = "${var.event_created_topic_arn}"
+  protocol             = "sqs"
+  endpoint             = "${aws_sqs_queue.events.arn}"
+  raw_message_delivery = "${var.raw_message_delivery}"
 }
 
 resource "aws_sqs_queue_policy" "queue_policy" {
@@ -49,8 +50,15 @@ module "consumer_lambda" {
   stage          = "${var.stage}"
 
   environment = {
-    SQS_URL           = "${aws_sqs_queue.events.id}"
-    WORKER_LAMBDA_ARN = "${module.worker_lambda.arn}"
+    DB_URL              = "${var.analytics_db_url}"
+    DIRECT_SINK         = "${var.consumer_direct_sink}"
+    LOAD_METHOD         = "${var.load_method}"
+    RECEIVERS           = "${var.consumer_receivers}"
+    SCALE_OUT_MAX       = "${var.consumer_scale_out_max}"
+    SCALE_OUT_THRESHOLD = "${var.consumer_scale_out_threshold}"
+    SQS_URL             = "${aws_sqs_queue.events.id}"
+    TABLE_NAME          = "${var.analytics_db_table}"
+    WORKER_LAMBDA_ARN   = "${module.worker_lambda.arn}"
   }
 }
 
@@ -64,8 +72,9 @@ module "worker_lambda" {
   stage          = "${var.stage}"
 
   environment = {
-    DB_URL     = "${var.analytics_db_url}"
-    TABLE_NAME = "${var.analytics_db_table}"
+    DB_URL      = "${var.analytics_db_url}"
+    LOAD_METHOD = "${var.load_method}"
+    TABLE_NAME  = "${var.analytics_db_table}"
   }
 }
 
@@ -80,8 +89,11 @@ resource "aws_iam_role_policy" "consumer" {
   "Statement": [
     {
       "Action": [
+        "sqs:ChangeMessageVisibility",
+        "sqs:ChangeMessageVisibilityBatch",
         "sqs:DeleteMessage",
         "sqs:DeleteMessageBatch",
+        "sqs:GetQueueAttributes",
         "sqs:ReceiveMessage"
       ],
       "Effect": "Allow",
@@ -93,7 +105,10 @@ resource "aws_iam_role_policy" "consumer" {
         "lambda:InvokeFunction"
       ],
       "Effect": "Allow",
-      "Resource": "${module.worker_lambda.arn}"
+      "Resource": [
+        "${module.worker_lambda.arn}",
+        "${module.consumer_lambda.arn}"
+      ]
     }
   ]
 }
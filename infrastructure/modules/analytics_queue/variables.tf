@@ -8,3 +8,33 @@ variable "consumer_schedule" {
   default     = "rate(5 minutes)"
   description = "Schedule expression for the Cloudwatch cron event that triggers the consumer Lambda."
 }
+
+variable "consumer_receivers" {
+  default     = 1
+  description = "Number of concurrent SQS receivers in the consumer Lambda."
+}
+
+variable "raw_message_delivery" {
+  default     = false
+  description = "Deliver events to the queue as is instead of wrapped in SNS notification envelopes. The consumer handles both formats."
+}
+
+variable "consumer_scale_out_threshold" {
+  default     = 1000
+  description = "Queue backlog per additional consumer Lambda instance."
+}
+
+variable "consumer_scale_out_max" {
+  default     = 0
+  description = "Max number of additional consumer instances to invoke on a backlog. Zero disables scaling out."
+}
+
+variable "consumer_direct_sink" {
+  default     = "false"
+  description = "Have the consumer store events into the database directly instead of invoking the worker Lambda."
+}
+
+variable "load_method" {
+  default     = "values"
+  description = "How events are inserted into the database, one of the loaders in functions/analytics_worker/store.py."
+}
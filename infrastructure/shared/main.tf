@@ -29,19 +29,33 @@ resource "aws_security_group" "allow_postgres_from_all" {
   }
 }
 
+# The bundled psycopg2 is linked against libpq 9.6, which can't authenticate
+# with the scram-sha-256 password hashes that newer versions default to:
+resource "aws_db_parameter_group" "analytics_db" {
+  name   = "shared-analytics-db-postgres16"
+  family = "postgres16"
+
+  parameter {
+    name  = "password_encryption"
+    value = "md5"
+  }
+}
+
 resource "aws_db_instance" "shared_analytics_db" {
-  identifier                = "shared-analytics-db"
-  allocated_storage         = 20
-  storage_type              = "gp2"
-  engine                    = "postgres"
-  engine_version            = "9.6.5"
-  final_snapshot_identifier = "shared-analytics-db-final-snapshot"
-  instance_class            = "db.t2.micro"
-  name                      = "analytics_db"
-  username                  = "${var.analytics_db_master_username}"
-  password                  = "${var.analytics_db_master_password}"
-  port                      = 5432
-  publicly_accessible       = true
-  backup_retention_period   = 7
-  vpc_security_group_ids    = ["${aws_security_group.allow_postgres_from_all.id}"]
+  identifier                  = "shared-analytics-db"
+  allocated_storage           = 20
+  storage_type                = "gp2"
+  engine                      = "postgres"
+  engine_version              = "16"
+  final_snapshot_identifier   = "shared-analytics-db-final-snapshot"
+  instance_class              = "db.t3.micro"
+  name                        = "analytics_db"
+  username                    = "${var.analytics_db_master_username}"
+  password                    = "${var.analytics_db_master_password}"
+  port                        = 5432
+  publicly_accessible         = true
+  backup_retention_period     = 7
+  parameter_group_name        = "${aws_db_parameter_group.analytics_db.name}"
+  allow_major_version_upgrade = true
+  vpc_security_group_ids      = ["${aws_security_group.allow_postgres_from_all.id}"]
 }
@@ -0,0 +1,227 @@
+"""
+Versioned schema migrations for the analytics database.
+
+Migrations are SQL files in `migrations/` named `<version>_<name>.sql`, e.g.
+`0002_event_timestamp_index.sql`, with the statements to apply following a
+`-- migrate:up` line and the statements to roll back following a
+`-- migrate:down` line. Statements may refer to `{schema}`, `{table}`,
+`{producer}` and `{consumer}`, so literal braces need to be doubled.
+
+Each migration runs in a single transaction unless it contains a
+`-- migrate:no-transaction` line. Such migrations, e.g. ones using
+`CREATE INDEX CONCURRENTLY`, run statement by statement in autocommit mode
+and should be written to be safely re-run in case one of the statements
+fails. Statements are split at semicolons ending a line.
+
+Applied versions are tracked in a table in the stage schema.
+
+Monthly partitions of the events table aren't part of the migrations since
+they have to be created ahead of time, see `create_partitions`.
+"""
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import timedelta
+import os
+import re
+
+MIGRATIONS_PATH = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)), 'migrations')
+TRACKING_TABLE = 'schema_migrations'
+
+FILE_PATTERN = re.compile(r'(\d+)_(\w+)\.sql$')
+SECTION_PATTERN = re.compile(r'^-- migrate:(up|down)\s*$', re.M)
+NO_TRANSACTION = re.compile(r'^-- migrate:no-transaction\s*$', re.M)
+STATEMENT_END = re.compile(r';\s*$', re.M)
+
+Migration = namedtuple('Migration', 'version name up down transactional')
+
+# Rows of the new partition's range have to leave the default partition
+# before the partition can be attached:
+CREATE_PARTITION_SCRIPT = """
+DO $$
+BEGIN
+  IF to_regclass('{partition}') IS NULL THEN
+    CREATE TABLE {partition} (LIKE {table} INCLUDING DEFAULTS);
+    WITH moved AS (
+      DELETE FROM {table}_default
+      WHERE event_timestamp >= '{start}' AND event_timestamp < '{end}'
+      RETURNING *
+    )
+    INSERT INTO {partition} SELECT * FROM moved;
+    ALTER TABLE {table} ATTACH PARTITION {partition}
+      FOR VALUES FROM ('{start}') TO ('{end}');
+  END IF;
+END
+$$;
+"""
+
+
+def load(path=MIGRATIONS_PATH):
+    """Return migrations found in `path`, ordered by version."""
+    migrations = []
+    for file_name in os.listdir(path):
+        match = FILE_PATTERN.match(file_name)
+        if not match:
+            continue
+        with open(os.path.join(path, file_name)) as f:
+            source = f.read()
+        parts = SECTION_PATTERN.split(source)
+        sections = dict(zip(parts[1::2], parts[2::2]))
+        if 'up' not in sections:
+            raise ValueError(f'No -- migrate:up section in {file_name}')
+        migrations.append(
+            Migration(
+                int(match.group(1)), match.group(2), sections['up'],
+                sections.get('down', ''), not NO_TRANSACTION.search(source)))
+
+    migrations.sort(key=lambda m: m.version)
+    versions = [m.version for m in migrations]
+    if len(set(versions)) != len(versions):
+        raise ValueError(f'Duplicate migration versions in {path}')
+    return migrations
+
+
+def status(conn, schema, migrations=None):
+    """
+    Return (migration, applied_at) tuples for all migrations, with
+    applied_at None for pending ones.
+    """
+    applied = _applied(conn, schema)
+    return [(m, applied.get(m.version))
+            for m in (migrations if migrations is not None else load())]
+
+
+def apply(conn, params, target=None, migrations=None):
+    """
+    Apply pending migrations up to and including version `target`, or all
+    of them. `params` holds the values for the statement placeholders.
+    Return the applied migrations.
+    """
+    schema = params['schema']
+    done = []
+    with _lock(conn, schema):
+        applied = _applied(conn, schema)
+        for m in (migrations if migrations is not None else load()):
+            if target is not None and m.version > target:
+                break
+            if m.version in applied:
+                continue
+            _run(conn, m.up.format(**params), m.transactional, f"""
+                INSERT INTO {schema}.{TRACKING_TABLE} (version, name)
+                VALUES ({m.version}, '{m.name}')
+            """)
+            done.append(m)
+    return done
+
+
+def rollback(conn, params, steps=1, migrations=None):
+    """
+    Roll back the given number of most recently applied migrations. Return
+    the rolled back migrations.
+    """
+    schema = params['schema']
+    done = []
+    with _lock(conn, schema):
+        applied = _applied(conn, schema)
+        by_version = {
+            m.version: m
+            for m in (migrations if migrations is not None else load())
+        }
+        for version in sorted(applied, reverse=True)[:steps]:
+            if version not in by_version:
+                raise ValueError(f'No migration file for version {version}')
+            m = by_version[version]
+            _run(conn, m.down.format(**params), m.transactional, f"""
+                DELETE FROM {schema}.{TRACKING_TABLE}
+                WHERE version = {m.version}
+            """)
+            done.append(m)
+    return done
+
+
+def create_partitions(conn, table, start, until):
+    """
+    Create monthly partitions of `table`, named e.g. `events_y2018m01`, for
+    the months from the one of date `start` through the one of date `until`.
+    Events that arrived in the default partition for these months are moved
+    over, a month per transaction. Existing partitions are left alone.
+    Return the partition names.
+    """
+    autocommit = conn.autocommit
+    conn.autocommit = True
+    start = start.replace(day=1)
+    partitions = []
+    try:
+        with conn.cursor() as cur:
+            while start <= until:
+                end = (start + timedelta(days=32)).replace(day=1)
+                partition = f'{table}_{start:y%Ym%m}'
+                cur.execute(
+                    CREATE_PARTITION_SCRIPT.format(
+                        table=table,
+                        partition=partition,
+                        start=start,
+                        end=end))
+                partitions.append(partition)
+                start = end
+    finally:
+        conn.autocommit = autocommit
+    return partitions
+
+
+def split_statements(sql):
+    """
+    Split SQL at semicolons ending a line, leaving out parts with nothing but
+    comments.
+    """
+    return [
+        statement for statement in STATEMENT_END.split(sql)
+        if re.sub(r'--.*$', '', statement, flags=re.M).strip()
+    ]
+
+
+def _applied(conn, schema):
+    """Return applied_at timestamps by applied version."""
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS {schema}.{TRACKING_TABLE} (
+              version     integer PRIMARY KEY,
+              name        varchar(128) NOT NULL,
+              applied_at  timestamp NOT NULL DEFAULT current_timestamp
+            )
+        """)
+        cur.execute(
+            f'SELECT version, applied_at FROM {schema}.{TRACKING_TABLE}')
+        return dict(cur.fetchall())
+
+
+def _run(conn, sql, transactional, record_sql):
+    if transactional:
+        conn.autocommit = False
+        with conn, conn.cursor() as cur:
+            cur.execute(sql)
+            cur.execute(record_sql)
+    else:
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            for statement in split_statements(sql):
+                cur.execute(statement)
+            cur.execute(record_sql)
+
+
+@contextmanager
+def _lock(conn, schema):
+    """Hold a session level advisory lock serializing migrations of schema."""
+    key = f'{TRACKING_TABLE}.{schema}'
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute('SELECT pg_advisory_lock(hashtext(%s))', [key])
+    try:
+        yield
+    finally:
+        if not conn.closed:
+            conn.rollback()
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute('SELECT pg_advisory_unlock(hashtext(%s))', [key])
@@ -0,0 +1,28 @@
+-- Events table as originally created by `inv init-db`, so that databases
+-- initialized before migrations were introduced start out at this version.
+
+-- migrate:up
+CREATE TABLE IF NOT EXISTS {table} (
+  id                    bigserial PRIMARY KEY,
+  event_id              varchar(36) NOT NULL,
+  event_timestamp       timestamp NOT NULL,
+  event_type            varchar(128) NOT NULL,
+  event_version         varchar(12) NOT NULL,
+  app_title             varchar(128) NOT NULL,
+  app_version           varchar(12) NOT NULL,
+  user_id               varchar(128) NOT NULL,
+  user_name             varchar(128) NOT NULL,
+  created_at            timestamp DEFAULT current_timestamp,
+  meta                  jsonb,
+  token_payload         jsonb
+);
+CREATE UNIQUE INDEX IF NOT EXISTS event_id on {table}(event_id);
+CREATE INDEX IF NOT EXISTS event_type on {table}(event_type);
+
+GRANT SELECT, INSERT, UPDATE ON {table} TO "{producer}";
+GRANT SELECT ON {table} TO "{consumer}";
+GRANT USAGE, SELECT, UPDATE ON {table}_id_seq TO "{producer}";
+GRANT USAGE, SELECT ON {table}_id_seq TO "{consumer}";
+
+-- migrate:down
+DROP TABLE {table};
@@ -0,0 +1,27 @@
+-- Event counts per event type and app, maintained by the loaders in the
+-- same transaction as the inserted events.
+
+-- migrate:up
+CREATE TABLE {table}_per_minute (
+  bucket                timestamp NOT NULL,
+  event_type            varchar(128) NOT NULL,
+  app_title             varchar(128) NOT NULL,
+  count                 bigint NOT NULL,
+  PRIMARY KEY (bucket, event_type, app_title)
+);
+CREATE TABLE {table}_per_hour (LIKE {table}_per_minute INCLUDING ALL);
+
+-- Backfill from events stored so far:
+INSERT INTO {table}_per_minute
+SELECT date_trunc('minute', event_timestamp), event_type, app_title, count(*)
+FROM {table} GROUP BY 1, 2, 3;
+INSERT INTO {table}_per_hour
+SELECT date_trunc('hour', bucket), event_type, app_title, sum(count)
+FROM {table}_per_minute GROUP BY 1, 2, 3;
+
+GRANT SELECT, INSERT, UPDATE ON {table}_per_minute, {table}_per_hour
+  TO "{producer}";
+GRANT SELECT ON {table}_per_minute, {table}_per_hour TO "{consumer}";
+
+-- migrate:down
+DROP TABLE {table}_per_minute, {table}_per_hour;
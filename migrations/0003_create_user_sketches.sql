@@ -0,0 +1,20 @@
+-- HyperLogLog sketches of distinct user ids per day and app, see
+-- functions/analytics_worker/hll.py. Loaders insert a partial sketch per
+-- transaction rather than updating a shared row, so concurrent loaders never
+-- wait on each other. Partial sketches are merged when queried and by
+-- `inv compact-sketches`. Maintained from this migration on, earlier days
+-- aren't backfilled.
+
+-- migrate:up
+CREATE TABLE {table}_users_per_day (
+  day                   date NOT NULL,
+  app_title             varchar(128) NOT NULL,
+  sketch                bytea NOT NULL
+);
+CREATE INDEX users_per_day_key ON {table}_users_per_day (day, app_title);
+
+GRANT SELECT, INSERT ON {table}_users_per_day TO "{producer}";
+GRANT SELECT ON {table}_users_per_day TO "{consumer}";
+
+-- migrate:down
+DROP TABLE {table}_users_per_day;
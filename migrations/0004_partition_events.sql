@@ -0,0 +1,66 @@
+-- Range partition the events table by event_timestamp, needs Postgres 11 or
+-- later. The existing table becomes the default partition, from which
+-- `inv create-partitions --since` moves events over into monthly
+-- partitions. Unique keys of partitioned tables have to include the
+-- partition key, so the primary key and the event_id index are extended by
+-- event_timestamp.
+
+-- migrate:up
+DO $$
+DECLARE
+  base text := (parse_ident('{table}'))[2];
+BEGIN
+  EXECUTE format('ALTER TABLE {table} RENAME TO %I', base || '_default');
+  EXECUTE format('ALTER TABLE {table}_default DROP CONSTRAINT %I',
+                 base || '_pkey');
+  -- Kept for the partitioned index on event_type to use:
+  EXECUTE format('ALTER INDEX {schema}.event_type RENAME TO %I',
+                 base || '_default_event_type');
+END
+$$;
+DROP INDEX {schema}.event_id;
+
+CREATE TABLE {table} (
+  id                    bigint NOT NULL DEFAULT nextval('{table}_id_seq'),
+  event_id              varchar(36) NOT NULL,
+  event_timestamp       timestamp NOT NULL,
+  event_type            varchar(128) NOT NULL,
+  event_version         varchar(12) NOT NULL,
+  app_title             varchar(128) NOT NULL,
+  app_version           varchar(12) NOT NULL,
+  user_id               varchar(128) NOT NULL,
+  user_name             varchar(128) NOT NULL,
+  created_at            timestamp DEFAULT current_timestamp,
+  meta                  jsonb,
+  token_payload         jsonb,
+  PRIMARY KEY (id, event_timestamp)
+) PARTITION BY RANGE (event_timestamp);
+CREATE UNIQUE INDEX event_id on {table}(event_id, event_timestamp);
+CREATE INDEX event_type on {table}(event_type);
+ALTER SEQUENCE {table}_id_seq OWNED BY {table}.id;
+
+-- Builds the new unique indexes on existing events:
+ALTER TABLE {table} ATTACH PARTITION {table}_default DEFAULT;
+
+GRANT SELECT, INSERT, UPDATE ON {table} TO "{producer}";
+GRANT SELECT ON {table} TO "{consumer}";
+
+-- migrate:down
+CREATE TABLE {table}_merged (LIKE {table} INCLUDING DEFAULTS);
+INSERT INTO {table}_merged SELECT * FROM {table};
+ALTER SEQUENCE {table}_id_seq OWNED BY {table}_merged.id;
+DROP TABLE {table};
+
+DO $$
+DECLARE
+  base text := (parse_ident('{table}'))[2];
+BEGIN
+  EXECUTE format('ALTER TABLE {table}_merged RENAME TO %I', base);
+END
+$$;
+ALTER TABLE {table} ADD PRIMARY KEY (id);
+CREATE UNIQUE INDEX event_id on {table}(event_id);
+CREATE INDEX event_type on {table}(event_type);
+
+GRANT SELECT, INSERT, UPDATE ON {table} TO "{producer}";
+GRANT SELECT ON {table} TO "{consumer}";
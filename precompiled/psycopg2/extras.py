@@ -29,6 +29,9 @@ import os as _os
 import sys as _sys
 import time as _time
 import re as _re
+from collections import deque as _deque
+from datetime import datetime as _datetime
+from itertools import islice as _islice
 
 try:
     import logging as _logging
@@ -1162,7 +1165,7 @@ def _paginate(seq, page_size):
             return
 
 
-def execute_batch(cur, sql, argslist, page_size=100):
+def execute_batch(cur, sql, argslist, page_size=100, pager=None):
     r"""Execute groups of statements in fewer server roundtrips.
 
     Execute *sql* several times, against all parameters set (sequences or
@@ -1178,13 +1181,22 @@ def execute_batch(cur, sql, argslist, page_size=100):
     fewer multi-statement commands, each one containing at most *page_size*
     statements, resulting in a reduced number of server roundtrips.
 
+    If a *pager*, e.g. an `AdaptivePager`, is given, commands are sized in
+    bytes by the pager instead of *page_size*.
+
     """
+    if pager is not None:
+        _execute_pages(cur, b'', b';', b'',
+                       (cur.mogrify(sql, args) for args in argslist), pager)
+        return
+
     for page in _paginate(argslist, page_size=page_size):
         sqls = [cur.mogrify(sql, args) for args in page]
         cur.execute(b";".join(sqls))
 
 
-def execute_values(cur, sql, argslist, template=None, page_size=100):
+def execute_values(cur, sql, argslist, template=None, page_size=100,
+                   pager=None, encoder=None):
     '''Execute a statement using :sql:`VALUES` with a sequence of parameters.
 
     :param cur: the cursor to use to execute the query.
@@ -1210,6 +1222,12 @@ def execute_values(cur, sql, argslist, template=None, page_size=100):
         statement. If there are more items the function will execute more than
         one statement.
 
+    :param pager: size statements in bytes with a pager, e.g. an
+        `AdaptivePager`, instead of by *page_size*.
+
+    :param encoder: a `RowEncoder` to encode the rows with instead of
+        mogrifying them one by one with the default *template*.
+
     .. __: https://www.postgresql.org/docs/current/static/queries-values.html
 
     While :sql:`INSERT` is an obvious candidate for this function it is
@@ -1235,21 +1253,220 @@ def execute_values(cur, sql, argslist, template=None, page_size=100):
     # we can't just use sql % vals because vals is bytes: if sql is bytes
     # there will be some decoding error because of stupid codec used, and Py3
     # doesn't implement % on bytes.
+    if pager is not None:
+        execute_values_stream(
+            cur, sql, argslist, template, pager=pager, encoder=encoder)
+        return
+
     if not isinstance(sql, bytes):
         sql = sql.encode(_ext.encodings[cur.connection.encoding])
     pre, post = _split_sql(sql)
 
     for page in _paginate(argslist, page_size=page_size):
-        if template is None:
-            template = b'(' + b','.join([b'%s'] * len(page[0])) + b')'
+        if encoder is not None:
+            values = encoder.encode(page)
+        else:
+            if template is None:
+                template = b'(' + b','.join([b'%s'] * len(page[0])) + b')'
+            values = (cur.mogrify(template, args) for args in page)
         parts = pre[:]
-        for args in page:
-            parts.append(cur.mogrify(template, args))
+        for value in values:
+            parts.append(value)
             parts.append(b',')
         parts[-1:] = post
         cur.execute(b''.join(parts))
 
 
+def execute_values_stream(cur, sql, argslist, template=None,
+                          page_bytes=1 << 20, fetch=False, pager=None,
+                          encoder=None):
+    '''Execute a statement using :sql:`VALUES` over an iterable of parameters.
+
+    Like `execute_values()`, but *argslist* can be any iterable, e.g. a
+    generator, and is consumed lazily. Rows are mogrified into a single
+    reusable buffer, which is executed as one statement whenever adding the
+    next row would make it longer than *page_bytes* bytes, so memory use
+    doesn't grow with the number of rows. A single row longer than
+    *page_bytes* is executed in a statement of its own.
+
+    Pass a *pager*, e.g. an `AdaptivePager`, to have it choose the statement
+    size instead of *page_bytes*, and a `RowEncoder` as *encoder* to encode
+    rows with it instead of the default *template*.
+
+    If *fetch* is true, return the rows returned by all the statements, e.g.
+    by an :sql:`INSERT ... RETURNING`.
+    '''
+    if not isinstance(sql, bytes):
+        sql = sql.encode(_ext.encodings[cur.connection.encoding])
+    pre, post = _split_sql(sql)
+
+    def values(template):
+        for args in argslist:
+            if template is None:
+                template = b'(' + b','.join([b'%s'] * len(args)) + b')'
+            yield cur.mogrify(template, args)
+
+    result = [] if fetch else None
+    _execute_pages(cur, b''.join(pre), b',', b''.join(post),
+                   encoder.encode(argslist) if encoder is not None
+                   else values(template),
+                   pager or BytePager(page_bytes), result)
+    return result
+
+
+class BytePager(object):
+    """Size paged statements by a budget of *page_bytes* bytes.
+
+    Keeps track of the rows, bytes and execution time in seconds of the most
+    recent *history* pages in `!pages`, and of the totals.
+    """
+
+    def __init__(self, page_bytes=1 << 20, history=1000):
+        self.page_bytes = page_bytes
+        self.pages = _deque(maxlen=history)
+        self.total_pages = 0
+        self.total_rows = 0
+        self.total_bytes = 0
+        self.total_time = 0.0
+
+    def record(self, rows, nbytes, seconds):
+        """Record the execution of a page."""
+        self.pages.append((rows, nbytes, seconds))
+        self.total_pages += 1
+        self.total_rows += rows
+        self.total_bytes += nbytes
+        self.total_time += seconds
+
+
+class AdaptivePager(BytePager):
+    """Size paged statements to take about *target_time* seconds each.
+
+    After every page the byte budget is scaled by the ratio of the target
+    time to the measured round trip time, by at most a factor of two per
+    page and within *min_bytes* and *max_bytes*. Pages dominated by the
+    round trip latency grow the budget, so small rows need fewer round trips,
+    while slow pages of wide rows shrink it.
+    """
+
+    def __init__(self, page_bytes=1 << 16, target_time=0.05,
+                 min_bytes=1 << 12, max_bytes=1 << 24, history=1000):
+        BytePager.__init__(self, page_bytes, history)
+        self.target_time = target_time
+        self.min_bytes = min_bytes
+        self.max_bytes = max_bytes
+
+    def record(self, rows, nbytes, seconds):
+        BytePager.record(self, rows, nbytes, seconds)
+        ratio = self.target_time / max(seconds, 1e-6)
+        size = max(nbytes, self.page_bytes / 2) * min(max(ratio, 0.5), 2.0)
+        self.page_bytes = int(min(max(size, self.min_bytes), self.max_bytes))
+
+
+class RowEncoder(object):
+    """Encode rows of parameters into :sql:`VALUES` entries.
+
+    The result is the same as ``cur.mogrify("(%s,%s,...)", row)`` with a
+    placeholder per column, byte for byte, but faster for wide rows of simple
+    types: a quoting function is picked per column from the first rows
+    encoded, and whole columns of *chunk_size* rows are quoted at once.
+    `!str` values, e.g. ISO timestamps and JSON serialized beforehand, and
+    naive `!datetime` values are quoted directly; anything else is passed
+    to `!mogrify()`.
+    """
+
+    def __init__(self, cur, chunk_size=1000):
+        self.cur = cur
+        self.chunk_size = chunk_size
+        self.encoding = _ext.encodings[cur.connection.encoding]
+        self.standard_strings = cur.connection.get_parameter_status(
+            'standard_conforming_strings') == 'on'
+        self._quoters = None
+
+    def encode(self, argslist):
+        """Return an iterator of encoded rows for an iterable of rows."""
+        it = iter(argslist)
+        while 1:
+            chunk = list(_islice(it, self.chunk_size))
+            if not chunk:
+                return
+            for row in self._encode_chunk(chunk):
+                yield row
+
+    def _encode_chunk(self, rows):
+        if len(set(map(len, rows))) != 1:
+            raise ValueError("rows must have the same number of values")
+        columns = list(zip(*rows))
+        if self._quoters is None:
+            self._quoters = [self._pick(column) for column in columns]
+        quoted = [quote(column)
+                  for quote, column in zip(self._quoters, columns)]
+        # Quoted values can't contain NUL characters, which makes them
+        # handy separators for encoding a whole chunk at once
+        text = '\x00'.join(['(' + ','.join(values) + ')'
+                            for values in zip(*quoted)])
+        return text.encode(self.encoding).split(b'\x00')
+
+    def _pick(self, column):
+        for value in column:
+            if type(value) is str:
+                return self._quote_str
+            if type(value) is _datetime:
+                return self._quote_datetime
+            if value is not None:
+                break
+        return self._quote_any
+
+    def _quote_str(self, column):
+        if set(map(type, column)) != {str}:
+            return [self._quote_str([v])[0] if type(v) is str
+                    else self._mogrify(v) for v in column]
+        joined = '\x00'.join(column)
+        if (joined.count('\x00') != len(column) - 1
+                or not self.standard_strings and '\\' in joined):
+            # NUL raises, backslashes need escaping
+            return [self._mogrify(v) for v in column]
+        return ("'" + joined.replace("'", "''").replace("\x00", "'\x00'") +
+                "'").split('\x00')
+
+    def _quote_datetime(self, column):
+        return ["'" + v.isoformat() + "'::timestamp"
+                if type(v) is _datetime and v.tzinfo is None
+                else self._mogrify(v) for v in column]
+
+    def _quote_any(self, column):
+        return [self._mogrify(v) for v in column]
+
+    def _mogrify(self, value):
+        return self.cur.mogrify('%s', (value,)).decode(self.encoding)
+
+
+def _execute_pages(cur, pre, sep, post, parts, pager, result=None):
+    """Execute *parts* joined by *sep* in statements sized by *pager*."""
+    buf = bytearray(pre)
+    rows = 0
+    for part in parts:
+        if rows and (len(buf) + len(part) + len(post) > pager.page_bytes):
+            _execute_buffer(cur, buf, post, rows, pager, result)
+            del buf[len(pre):]
+            rows = 0
+        buf += part
+        buf += sep
+        rows += 1
+
+    if rows:
+        _execute_buffer(cur, buf, post, rows, pager, result)
+
+
+def _execute_buffer(cur, buf, post, rows, pager, result):
+    """Execute a buffer of parts ending with a trailing separator."""
+    buf[-1:] = post
+    start = _time.perf_counter()
+    cur.execute(bytes(buf))
+    if result is not None:
+        result.extend(cur.fetchall())
+    pager.record(rows, len(buf), _time.perf_counter() - start)
+
+
 def _split_sql(sql):
     """Split *sql* on a single ``%s`` placeholder.
 
@@ -24,6 +24,9 @@ This module implements thread-safe (and not) connection pools.
 # FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public
 # License for more details.
 
+from bisect import bisect_left
+from time import monotonic as _time
+
 import psycopg2
 import psycopg2.extensions as _ext
 
@@ -32,9 +35,99 @@ class PoolError(psycopg2.Error):
     pass
 
 
+class Histogram(object):
+    """Counts of durations in seconds, in exponentially growing buckets."""
+
+    bounds = (0.0001, 0.001, 0.01, 0.1, 1.0, 10.0, float('inf'))
+
+    def __init__(self):
+        self.counts = [0] * len(self.bounds)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'mean': self.sum / self.count if self.count else 0.0,
+            'max': self.max,
+            'buckets': list(zip(self.bounds, self.counts)),
+        }
+
+
+class PoolStats(object):
+    """Counters of a connection pool, updated by the pool.
+
+    Pool size is tracked as the number of connections in use and open,
+    along with their maximums and averages over time.
+    """
+
+    def __init__(self):
+        self.started = self._resized = _time()
+        self.checkouts = 0
+        self.failed_checkouts = 0
+        self.connections_created = 0
+        self.connections_closed = 0
+        self.wait_time = Histogram()
+        self.hold_time = Histogram()
+        self.in_use = self.max_in_use = 0
+        self.open = self.max_open = 0
+        self._in_use_area = self._open_area = 0.0
+
+    def resize(self, in_use, open):
+        now = _time()
+        self._in_use_area += self.in_use * (now - self._resized)
+        self._open_area += self.open * (now - self._resized)
+        self._resized = now
+        self.in_use, self.open = in_use, open
+        self.max_in_use = max(self.max_in_use, in_use)
+        self.max_open = max(self.max_open, open)
+
+    def snapshot(self):
+        now = _time()
+        elapsed = now - self.started
+        since = now - self._resized
+        return {
+            'checkouts': self.checkouts,
+            'failed_checkouts': self.failed_checkouts,
+            'connections_created': self.connections_created,
+            'connections_closed': self.connections_closed,
+            'in_use': self.in_use,
+            'max_in_use': self.max_in_use,
+            'mean_in_use': ((self._in_use_area + self.in_use * since) /
+                            elapsed if elapsed else self.in_use),
+            'open': self.open,
+            'max_open': self.max_open,
+            'mean_open': ((self._open_area + self.open * since) /
+                          elapsed if elapsed else self.open),
+            'wait_time': self.wait_time.snapshot(),
+            'hold_time': self.hold_time.snapshot(),
+        }
+
+
 class AbstractConnectionPool(object):
     """Generic key-based pooling code."""
 
+    # Connections older than this many seconds are retired
+    max_lifetime = None
+    # Connections idle in the pool for longer than this are retired
+    max_idle = None
+    # Connections idle for longer than this are checked with a query on
+    # checkout; quicker checks not involving the server are always done
+    check_idle = None
+    # Called with an event name and a duration in seconds or None on
+    # 'connect', 'close', 'checkout' (wait time), 'checkout_failed' (wait
+    # time) and 'checkin' (hold time). Keep it quick, thread safe pools call
+    # it with their lock held
+    callback = None
+
     def __init__(self, minconn, maxconn, *args, **kwargs):
         """Initialize the connection pool.
 
@@ -53,20 +146,60 @@ class AbstractConnectionPool(object):
         self._used = {}
         self._rused = {}    # id(conn) -> key map
         self._keys = 0
+        self._created = {}  # id(conn) -> creation time
+        self._idle = {}     # id(conn) -> time put back into the pool
+        self._checkout = {}  # id(conn) -> time handed out
+        self._checking = 0  # connections out of the pool for a check
+        self._stats = PoolStats()
+
+        self._prewarm()
+        self._resized()
 
+    def _prewarm(self):
+        """Create the initial 'minconn' connections."""
         for i in range(self.minconn):
             self._connect()
 
+    def _newconn(self):
+        """Create a new connection without assigning it."""
+        return self._adopt(psycopg2.connect(*self._args, **self._kwargs))
+
+    def _adopt(self, conn):
+        """Start keeping track of a new connection."""
+        self._created[id(conn)] = self._idle[id(conn)] = _time()
+        self._stats.connections_created += 1
+        self._notify('connect')
+        return conn
+
+    def _notify(self, event, value=None):
+        if self.callback is not None:
+            self.callback(event, value)
+
+    def _resized(self):
+        self._stats.resize(
+            len(self._used),
+            len(self._used) + self._checking + len(self._pool))
+
+    def _stats_snapshot(self):
+        """Return a snapshot of the pool's statistics as a dict."""
+        return self._stats.snapshot()
+
     def _connect(self, key=None):
         """Create a new connection and assign it to 'key' if not None."""
-        conn = psycopg2.connect(*self._args, **self._kwargs)
+        conn = self._newconn()
         if key is not None:
-            self._used[key] = conn
-            self._rused[id(conn)] = key
+            self._assign(key, conn)
         else:
             self._pool.append(conn)
         return conn
 
+    def _assign(self, key, conn):
+        """Hand out 'conn' to 'key'."""
+        self._used[key] = conn
+        self._rused[id(conn)] = key
+        self._checkout[id(conn)] = _time()
+        self._stats.checkouts += 1
+
     def _getkey(self):
         """Return a new unique key."""
         self._keys += 1
@@ -82,14 +215,72 @@ class AbstractConnectionPool(object):
         if key in self._used:
             return self._used[key]
 
-        if self._pool:
-            self._used[key] = conn = self._pool.pop()
-            self._rused[id(conn)] = key
-            return conn
-        else:
-            if len(self._used) == self.maxconn:
-                raise PoolError("connection pool exhausted")
-            return self._connect(key)
+        while self._pool:
+            # Most recently used first, so that extra connections go idle
+            conn = self._pool.pop()
+            if self._usable(conn) and (
+                    not self._stale(conn) or self._alive(conn)):
+                self._assign(key, conn)
+                self._resized()
+                return conn
+            self._discard(conn)
+
+        if len(self._used) + self._checking >= self.maxconn:
+            raise PoolError("connection pool exhausted")
+        conn = self._connect(key)
+        self._resized()
+        return conn
+
+    def _expired(self, conn, now):
+        """Return True if 'conn' is past its max lifetime."""
+        if self.max_lifetime is None:
+            return False
+        return now - self._created.get(id(conn), now) >= self.max_lifetime
+
+    def _idle_time(self, conn, now):
+        return now - self._idle.get(id(conn), now)
+
+    def _usable(self, conn):
+        """Check whether a pooled connection can still be handed out,
+        without involving the server."""
+        if conn.closed:
+            return False
+        if conn.get_transaction_status() == _ext.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        now = _time()
+        if self._expired(conn, now):
+            return False
+        if (self.max_idle is not None
+                and self._idle_time(conn, now) >= self.max_idle):
+            return False
+        return True
+
+    def _stale(self, conn):
+        """Return True if a pooled connection needs checking with a query."""
+        return (self.check_idle is not None
+                and self._idle_time(conn, _time()) >= self.check_idle)
+
+    def _alive(self, conn):
+        """Check a connection with a round trip to the server."""
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def _discard(self, conn):
+        """Close a connection and forget about it."""
+        self._created.pop(id(conn), None)
+        self._idle.pop(id(conn), None)
+        self._stats.connections_closed += 1
+        self._notify('close')
+        try:
+            conn.close()
+        except Exception:
+            pass
 
     def _putconn(self, conn, key=None, close=False):
         """Put away a connection."""
@@ -101,30 +292,42 @@ class AbstractConnectionPool(object):
         if not key:
             raise PoolError("trying to put unkeyed connection")
 
-        if len(self._pool) < self.minconn and not close:
+        checkout = self._checkout.pop(id(conn), None)
+        if checkout is not None:
+            hold = _time() - checkout
+            self._stats.hold_time.add(hold)
+            self._notify('checkin', hold)
+
+        if (len(self._pool) < self.minconn and not close
+                and not self._expired(conn, _time())):
             # Return the connection into a consistent state before putting
             # it back into the pool
             if not conn.closed:
                 status = conn.get_transaction_status()
                 if status == _ext.TRANSACTION_STATUS_UNKNOWN:
                     # server connection lost
-                    conn.close()
+                    self._discard(conn)
                 elif status != _ext.TRANSACTION_STATUS_IDLE:
                     # connection in error or in transaction
                     conn.rollback()
+                    self._idle[id(conn)] = _time()
                     self._pool.append(conn)
                 else:
                     # regular idle connection
+                    self._idle[id(conn)] = _time()
                     self._pool.append(conn)
-            # If the connection is closed, we just discard it.
+            else:
+                # If the connection is closed, we just discard it.
+                self._discard(conn)
         else:
-            conn.close()
+            self._discard(conn)
 
         # here we check for the presence of key because it can happen that a
         # thread tries to put back a connection after a call to close
         if not self.closed or key in self._used:
             del self._used[key]
             del self._rused[id(conn)]
+        self._resized()
 
     def _closeall(self):
         """Close all connections.
@@ -140,7 +343,10 @@ class AbstractConnectionPool(object):
                 conn.close()
             except:
                 pass
+            self._stats.connections_closed += 1
+            self._notify('close')
         self.closed = True
+        self._stats.resize(0, 0)
 
 
 class SimpleConnectionPool(AbstractConnectionPool):
@@ -149,41 +355,155 @@ class SimpleConnectionPool(AbstractConnectionPool):
     getconn = AbstractConnectionPool._getconn
     putconn = AbstractConnectionPool._putconn
     closeall = AbstractConnectionPool._closeall
+    stats = AbstractConnectionPool._stats_snapshot
 
 
 class ThreadedConnectionPool(AbstractConnectionPool):
-    """A connection pool that works with the threading module."""
+    """A connection pool that works with the threading module.
+
+    When the pool is exhausted `!getconn()` waits for a connection to be put
+    back for up to 'timeout' seconds. Pass 'max_lifetime', 'max_idle' and
+    'check_idle' (in seconds) to retire and check pooled connections, see
+    `AbstractConnectionPool`; queries checking idle connections run with the
+    pool's lock released. The initial 'minconn' connections are created in
+    parallel.
+
+    `!stats()` returns a snapshot of counters and wait and hold time
+    histograms, and 'callback' is called on pool events, see
+    `AbstractConnectionPool.callback`.
+    """
 
-    def __init__(self, minconn, maxconn, *args, **kwargs):
+    def __init__(self, minconn, maxconn, *args, timeout=30.0,
+                 max_lifetime=None, max_idle=None, check_idle=None,
+                 callback=None, **kwargs):
         """Initialize the threading lock."""
         import threading
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.max_idle = max_idle
+        self.check_idle = check_idle
+        self.callback = callback
         AbstractConnectionPool.__init__(
             self, minconn, maxconn, *args, **kwargs)
-        self._lock = threading.Lock()
 
-    def getconn(self, key=None):
-        """Get a free connection and assign it to 'key' if not None."""
-        self._lock.acquire()
-        try:
+    def _prewarm(self):
+        """Create the initial connections in parallel."""
+        import threading
+        conns = []
+        errors = []
+
+        def connect():
+            try:
+                conn = psycopg2.connect(*self._args, **self._kwargs)
+                with self._lock:
+                    conns.append(self._adopt(conn))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=connect)
+                   for i in range(self.minconn)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if errors:
+            for conn in conns:
+                self._discard(conn)
+            raise errors[0]
+        self._pool.extend(conns)
+
+    def getconn(self, key=None, timeout=None):
+        """Get a free connection and assign it to 'key' if not None.
+
+        Wait for up to 'timeout' seconds, defaulting to the pool's timeout,
+        for a connection to become available if the pool is exhausted.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        start = _time()
+        deadline = start + timeout
+        with self._available:
+            try:
+                while True:
+                    if key in self._used and not self.closed:
+                        return self._used[key]  # no new checkout
+                    while (not self.closed and key not in self._used
+                           and not self._pool and len(self._used) +
+                           self._checking >= self.maxconn):
+                        remaining = deadline - _time()
+                        if remaining <= 0:
+                            raise PoolError("connection pool exhausted")
+                        self._available.wait(remaining)
+                    conn = self._checked(key)
+                    if conn is not None:
+                        break
+            except Exception:
+                self._stats.failed_checkouts += 1
+                self._notify('checkout_failed', _time() - start)
+                raise
+            wait = _time() - start
+            self._stats.wait_time.add(wait)
+            self._notify('checkout', wait)
+            return conn
+
+    def _checked(self, key):
+        """Get a connection like `!_getconn()`, but check stale pooled
+        connections with the lock released. Return None if the connection
+        checked turned out to be broken, to wait again for another one, or if
+        'key' got a connection in the meanwhile."""
+        if self.closed or key in self._used:
+            return self._getconn(key)
+        # Drop unusable connections first, so that no stale one below them
+        # gets checked by `!_getconn()` with the lock held
+        while self._pool and not self._usable(self._pool[-1]):
+            self._discard(self._pool.pop())
+            self._resized()
+        if not self._pool or not self._stale(self._pool[-1]):
             return self._getconn(key)
+        conn = self._pool[-1]
+
+        self._pool.pop()
+        self._checking += 1
+        self._available.release()
+        try:
+            alive = self._alive(conn)
         finally:
-            self._lock.release()
+            self._available.acquire()
+            self._checking -= 1
+
+        if not alive or self.closed:
+            self._discard(conn)
+            self._resized()
+            self._available.notify()  # free to connect in its place
+            if self.closed:
+                raise PoolError("connection pool is closed")
+            return None
+        if key in self._used:  # handed out to the same key meanwhile
+            self._pool.append(conn)
+            self._resized()
+            return None
+        self._assign(key if key is not None else self._getkey(), conn)
+        self._resized()
+        return conn
 
     def putconn(self, conn=None, key=None, close=False):
         """Put away an unused connection."""
-        self._lock.acquire()
-        try:
+        with self._available:
             self._putconn(conn, key, close)
-        finally:
-            self._lock.release()
+            self._available.notify()
 
     def closeall(self):
         """Close all connections (even the one currently in use.)"""
-        self._lock.acquire()
-        try:
+        with self._available:
             self._closeall()
-        finally:
-            self._lock.release()
+            self._available.notify_all()
+
+    def stats(self):
+        """Return a snapshot of the pool's statistics as a dict."""
+        with self._lock:
+            return self._stats_snapshot()
 
 
 class PersistentConnectionPool(AbstractConnectionPool):
@@ -2,18 +2,35 @@
 Management tasks for the analytics service.
 """
 import base64
-from datetime import datetime
+from datetime import date, datetime
+import glob
+import gzip
 import json
 import re
 import os
+import resource
+import sys
+import time
 import uuid
 
 from invoke import task
 
+import migrate as migrations
+
 ROOT = os.path.dirname(os.path.realpath(__file__))
 FUNCTIONS_PATH = os.path.join(ROOT, 'functions')
 PRECOMPILED_PATH = os.path.join(ROOT, 'precompiled')
 
+# Modules copied over from other functions' source, by function:
+SHARED_MODULES = {
+    'analytics_consumer': [
+        os.path.join('analytics_worker', 'binary_copy.py'),
+        os.path.join('analytics_worker', 'connection.py'),
+        os.path.join('analytics_worker', 'hll.py'),
+        os.path.join('analytics_worker', 'store.py')
+    ],
+}
+
 
 @task(iterable=['func'])
 def build(ctx, func=None):
@@ -43,6 +60,131 @@ def build(ctx, func=None):
 
             # Copy source:
             ctx.run('cp -r *.py build/')
+            _copy_shared_modules(ctx, f)
+
+
+@task
+def create_partitions(ctx, env=None, months=3, since=None):
+    """
+    Create monthly partitions of the events table for the current month and
+    the given number of months ahead. Events that arrived in the default
+    partition for these months are moved over. Run it regularly, e.g. daily.
+    Specify --since (a date) to also create the partitions of past months,
+    e.g. once after partitioning a table that already holds events.
+    """
+    today = datetime.utcnow().date()
+    month = today.month - 1 + int(months)
+    until = date(today.year + month // 12, month % 12 + 1, 1)
+    start = datetime.strptime(since, '%Y-%m-%d').date() if since else today
+    conn, params = _analytics_db(ctx, env)
+    for partition in migrations.create_partitions(conn, params['table'],
+                                                  start, until):
+        print('Partition', partition)
+    conn.close()
+
+
+@task
+def compact_sketches(ctx, env=None):
+    """
+    Merge the partial sketches of distinct users inserted by the loaders into
+    one sketch per day and app. Run it regularly, e.g. hourly.
+    """
+    _worker_path()
+    import store
+    conn, params = _analytics_db(ctx, env)
+    print('Removed', store.compact_sketches(conn, params['table']),
+          'sketches')
+    conn.close()
+
+
+@task
+def distinct_users(ctx, since, until=None, app=None, env=None):
+    """
+    Estimate distinct users per app between --since and --until (inclusive
+    dates, until defaults to today) by merging the HyperLogLog sketches of
+    these days.
+    """
+    _worker_path()
+    from hll import HyperLogLog, merge_all
+    conn, params = _analytics_db(ctx, env)
+    with conn.cursor() as cur:
+        cur.execute(
+            f"""
+            SELECT app_title, day, sketch FROM {params['table']}_users_per_day
+            WHERE day BETWEEN %s AND %s AND (%s IS NULL OR app_title = %s)
+            ORDER BY app_title
+        """, [since, until or datetime.utcnow().date(), app, app])
+        sketches = {}
+        days = {}
+        for app_title, day, sketch in cur:
+            if app_title not in sketches:
+                sketches[app_title] = HyperLogLog()
+                days[app_title] = set()
+            sketches[app_title].merge(HyperLogLog.from_bytes(sketch))
+            days[app_title].add(day)
+    conn.close()
+
+    for app_title, merged in sketches.items():
+        print(f'{app_title:40} {merged.count():>10} '
+              f'(±{merged.standard_error():.1%}, '
+              f'{len(days[app_title])} days)')
+    if len(sketches) > 1:
+        merged = merge_all(sketches.values())
+        print(f'{"all apps":40} {merged.count():>10}')
+
+
+@task
+def export(ctx,
+           since,
+           until=None,
+           format='jsonl',
+           output=None,
+           itersize=10000,
+           env=None):
+    """
+    Export events with event_timestamp in [--since, --until) into a gzipped
+    --format jsonl or csv file. Rows are streamed from the database, so memory
+    use stays constant however many rows are exported.
+    """
+    env = env or ctx['env']
+    until = until or datetime.utcnow().isoformat()
+    output = output or f'events_{env}_{since}_{until}.{format}.gz'.replace(
+        ':', '')
+    conn, params = _analytics_db(ctx, env)
+    query = f"""
+        SELECT * FROM {params['table']}
+        WHERE event_timestamp >= %s AND event_timestamp < %s
+        ORDER BY event_timestamp
+    """
+    start = time.perf_counter()
+
+    if format == 'csv':
+        with conn.cursor() as cur, gzip.open(output, 'wb') as f:
+            cur.copy_expert(
+                'COPY ({}) TO STDOUT WITH (FORMAT csv, HEADER)'.format(
+                    cur.mogrify(query, [since, until]).decode('utf-8')), f)
+            rows = cur.rowcount
+    elif format == 'jsonl':
+        # Named cursors fetch rows from the server in batches of itersize:
+        with conn.cursor(name='export') as cur, \
+                gzip.open(output, 'wt', encoding='utf-8') as f:
+            cur.itersize = int(itersize)
+            cur.execute(query, [since, until])
+            rows = 0
+            for row in cur:
+                if rows == 0:
+                    names = [column.name for column in cur.description]
+                f.write(json.dumps(dict(zip(names, row)), default=_isoformat))
+                f.write('\n')
+                rows += 1
+    else:
+        raise ValueError(f'Unknown export format {format}')
+    conn.close()
+
+    elapsed = time.perf_counter() - start
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f'Exported {rows} rows to {output} in {elapsed:.1f}s '
+          f'({rows / elapsed:.0f} rows/sec), peak RSS {peak_rss:.0f} MB')
 
 
 @task
@@ -69,21 +211,12 @@ def gen_event(ctx):
 @task
 def init_db(ctx, env=None):
     """
-    Initialize the analytics database. Operation is idempotent so running it
-    repeatedly shouldn't cause any adverse effects.
+    Initialize the analytics database by applying all migrations and
+    creating partitions. Operation is idempotent so running it repeatedly
+    shouldn't cause any adverse effects.
     """
-    env = env or ctx['env']
-    with ctx.cd(os.path.join(ROOT, 'infrastructure', 'shared')):
-        db_url = ctx.run('terraform output analytics_db_url', hide=True).stdout
-
-        with ctx.cd(os.path.join(ROOT, 'infrastructure', env)):
-            output = json.loads(
-                ctx.run('terraform output -json', hide=True).stdout)
-            sql_script = INIT_ANALYTICS_DB_SCRIPT.format(
-                table=output['analytics_db_schema']['value'] + '.events',
-                consumer=output['analytics_db_consumer_username']['value'],
-                producer=output['analytics_db_producer_username']['value'])
-            ctx.run(f"echo '{sql_script}' | psql {db_url}", echo=True)
+    migrate(ctx, env)
+    create_partitions(ctx, env)
 
 
 @task
@@ -122,6 +255,32 @@ def log(ctx, func, env=None):
     ctx.run(f'awslogs get --profile {prof} /aws/lambda/{func}_{env} --watch')
 
 
+@task
+def migrate(ctx, env=None, target=None):
+    """
+    Apply pending database migrations, up to version --target if given.
+    """
+    conn, params = _analytics_db(ctx, env)
+    applied = migrations.apply(
+        conn, params, target=int(target) if target else None)
+    for m in applied:
+        print('Applied', m.version, m.name)
+    if not applied:
+        print('No pending migrations')
+    conn.close()
+
+
+@task
+def migration_status(ctx, env=None):
+    """
+    List database migrations and when they were applied.
+    """
+    conn, params = _analytics_db(ctx, env)
+    for m, applied_at in migrations.status(conn, params['schema']):
+        print(f'{m.version:04d} {m.name:40} {applied_at or "pending"}')
+    conn.close()
+
+
 @task
 def psql(ctx):
     """
@@ -158,6 +317,33 @@ def publish_event(ctx, env=None, n=1):
                 echo=True)
 
 
+@task
+def rollback(ctx, env=None, steps=1):
+    """
+    Roll back the given number of most recently applied database migrations.
+    """
+    conn, params = _analytics_db(ctx, env)
+    for m in migrations.rollback(conn, params, steps=int(steps)):
+        print('Rolled back', m.version, m.name)
+    conn.close()
+
+
+@task(iterable=['func'])
+def benchmark(ctx, func=None):
+    """
+    Run benchmarks of Lambda handlers, i.e. test/benchmark_*.py files.
+    Specify --func to only benchmark specific functions.
+    """
+    for f in (func if func else _list_functions()):
+        path = os.path.join(FUNCTIONS_PATH, f)
+        if not glob.glob(os.path.join(path, 'test', 'benchmark_*.py')):
+            continue
+        with ctx.cd(path):
+            print('Benchmarking', f)
+            ctx.run('pipenv install --dev')
+            ctx.run('pipenv run python -m pytest -s test/benchmark_*.py')
+
+
 @task(iterable=['func'])
 def test(ctx, func=None):
     """
@@ -168,6 +354,13 @@ def test(ctx, func=None):
             print('Testing', f)
             ctx.run('pipenv install --dev')
             ctx.run('pipenv run python -m pytest -s --cov=main')
+    if not func:
+        # Migrations and the bundled psycopg2, in an environment that has
+        # psycopg2 installed:
+        with ctx.cd(os.path.join(FUNCTIONS_PATH, 'analytics_worker')):
+            print('Testing migrations and precompiled packages')
+            tests = os.path.join(ROOT, 'test')
+            ctx.run(f'pipenv run python -m pytest -s {tests}')
 
 
 @task
@@ -185,6 +378,7 @@ def update(ctx, func, env=None):
             build(ctx, [func])
         else:
             ctx.run('cp -r ./*.py build/')  # TODO: handle nested dirs
+            _copy_shared_modules(ctx, func)
 
         zip_file = 'package.zip'
         package(ctx, func, package_name=zip_file)
@@ -193,6 +387,45 @@ def update(ctx, func, env=None):
             echo=True)
 
 
+def _analytics_db(ctx, env=None):
+    """
+    Connect to the analytics database with admin credentials. Return the
+    connection and the stage's migration parameters.
+    """
+    import psycopg2
+    with ctx.cd(os.path.join(ROOT, 'infrastructure', 'shared')):
+        db_url = ctx.run('terraform output analytics_db_url', hide=True).stdout
+    with ctx.cd(os.path.join(ROOT, 'infrastructure', env or ctx['env'])):
+        output = json.loads(
+            ctx.run('terraform output -json', hide=True).stdout)
+    schema = output['analytics_db_schema']['value']
+    return psycopg2.connect(db_url.strip()), {
+        'schema': schema,
+        'table': schema + '.events',
+        'consumer': output['analytics_db_consumer_username']['value'],
+        'producer': output['analytics_db_producer_username']['value']
+    }
+
+
+def _worker_path():
+    """Make the worker's modules importable, e.g. `import store`."""
+    path = os.path.join(FUNCTIONS_PATH, 'analytics_worker')
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+
+def _copy_shared_modules(ctx, func):
+    for module in SHARED_MODULES.get(func, []):
+        ctx.run(f'cp {os.path.join(FUNCTIONS_PATH, module)} build/')
+
+
+def _isoformat(value):
+    """JSON encode datetimes in ISO 8601."""
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError(f'{type(value)} is not JSON serializable')
+
+
 def _list_functions():
     return next(os.walk(FUNCTIONS_PATH))[1]
 
@@ -201,27 +434,3 @@ def _printc(text, col='\033[0;33m'):
     """Print a line in color, defaulting to yellow."""
     print(f'{col}{text}\033[0m')
 
-
-INIT_ANALYTICS_DB_SCRIPT = """
-CREATE TABLE IF NOT EXISTS {table} (
-  id                    bigserial PRIMARY KEY,
-  event_id              varchar(36) NOT NULL,
-  event_timestamp       timestamp NOT NULL,
-  event_type            varchar(128) NOT NULL,
-  event_version         varchar(12) NOT NULL,
-  app_title             varchar(128) NOT NULL,
-  app_version           varchar(12) NOT NULL,
-  user_id               varchar(128) NOT NULL,
-  user_name             varchar(128) NOT NULL,
-  created_at            timestamp DEFAULT current_timestamp,
-  meta                  jsonb,
-  token_payload         jsonb
-);
-CREATE UNIQUE INDEX IF NOT EXISTS event_id on {table}(event_id);
-CREATE INDEX IF NOT EXISTS event_type on {table}(event_type);
-
-GRANT SELECT, INSERT, UPDATE ON {table} TO "{producer}";
-GRANT SELECT ON {table} TO "{consumer}";
-GRANT USAGE, SELECT, UPDATE ON {table}_id_seq TO "{producer}";
-GRANT USAGE, SELECT ON {table}_id_seq TO "{consumer}";
-"""
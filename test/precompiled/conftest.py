@@ -0,0 +1,9 @@
+from fixtures import TEST_DB_URL, terminate
+import pytest
+
+
+@pytest.fixture
+def dsn():
+    if not TEST_DB_URL:
+        pytest.skip('TEST_DB_URL not set')
+    return TEST_DB_URL
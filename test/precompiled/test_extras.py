@@ -0,0 +1,260 @@
+from datetime import date, datetime, timezone
+from decimal import Decimal
+import json
+import timeit
+import tracemalloc
+
+import psycopg2
+from psycopg2.extensions import cursor
+import pytest
+
+import vendored
+
+extras = vendored.load('extras')
+
+
+class CountingCursor(cursor):
+    """Cursor keeping track of the sizes of executed statements."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.statements = []
+
+    def execute(self, query, vars=None):
+        self.statements.append(len(query))
+        return super().execute(query, vars)
+
+
+@pytest.fixture
+def conn(dsn):
+    conn = psycopg2.connect(dsn)
+    with conn.cursor() as cur:
+        cur.execute('CREATE TEMP TABLE t (id int PRIMARY KEY, data text)')
+    yield conn
+    conn.close()
+
+
+def rows(n, width=10):
+    return ((i, f'{i:0{width}d}') for i in range(n))
+
+
+def stored(conn):
+    with conn.cursor() as cur:
+        cur.execute('SELECT id, data FROM t ORDER BY id')
+        return cur.fetchall()
+
+
+@pytest.mark.parametrize('page_bytes', [1, 100, 1000, 1 << 20])
+def test_stream_stores_same_rows(conn, page_bytes):
+    with conn.cursor(cursor_factory=CountingCursor) as cur:
+        extras.execute_values_stream(
+            cur, 'INSERT INTO t VALUES %s', rows(1000), page_bytes=page_bytes)
+        statements = cur.statements
+
+    assert stored(conn) == list(rows(1000))
+    if page_bytes > 1:
+        assert max(statements) <= page_bytes
+    else:
+        assert len(statements) == 1000  # a row per statement
+    print(f'page_bytes {page_bytes}: {len(statements)} statements')
+
+
+def test_stream_fetch_and_template(conn):
+    with conn.cursor() as cur:
+        returned = extras.execute_values_stream(
+            cur,
+            'INSERT INTO t VALUES %s RETURNING id',
+            ({'id': i, 'data': None} for i in range(500)),
+            template='(%(id)s, coalesce(%(data)s, \'x\'))',
+            page_bytes=500,
+            fetch=True)
+    assert sorted(returned) == [(i, ) for i in range(500)]
+    assert stored(conn)[-1] == (499, 'x')
+
+
+def test_stream_empty_iterable(conn):
+    with conn.cursor(cursor_factory=CountingCursor) as cur:
+        assert extras.execute_values_stream(
+            cur, 'INSERT INTO t VALUES %s', iter([]), fetch=True) == []
+        assert cur.statements == []
+
+
+def peak_memory(execute, n):
+    tracemalloc.start()
+    execute(n)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def test_stream_memory_stays_flat(conn):
+    def stream(n):
+        with conn.cursor() as cur:
+            cur.execute('TRUNCATE t')
+            extras.execute_values_stream(
+                cur, 'INSERT INTO t VALUES %s', rows(n, 100),
+                page_bytes=1 << 18)
+
+    def paged(n):
+        with conn.cursor() as cur:
+            cur.execute('TRUNCATE t')
+            extras.execute_values(
+                cur, 'INSERT INTO t VALUES %s', rows(n, 100), page_size=2000)
+
+    peaks = {}
+    for execute in [paged, stream]:
+        for n in [5000, 50000]:
+            peak = peaks[execute.__name__, n] = peak_memory(execute, n)
+            print(f'{execute.__name__} {n} rows: peak {peak} bytes')
+
+    assert peaks['stream', 50000] < 1.2 * peaks['stream', 5000]
+    assert peaks['stream', 50000] < peaks['paged', 50000]
+
+
+def test_adaptive_pager_converges_to_target_time():
+    def round_trip(nbytes):  # 10ms latency, 10 MB/s
+        return 0.01 + nbytes / 1e7
+
+    pager = extras.AdaptivePager(page_bytes=4096, target_time=0.05)
+    for _ in range(30):
+        pager.record(100, pager.page_bytes, round_trip(pager.page_bytes))
+    assert abs(pager.page_bytes - 400000) < 40000
+
+    pager.record(100, pager.page_bytes, 10 * round_trip(pager.page_bytes))
+    assert pager.page_bytes < 250000  # slowdown halves the budget at most
+    assert pager.total_pages == len(pager.pages) == 31
+
+
+@pytest.fixture
+def events_table(conn):
+    with conn.cursor() as cur:
+        cur.execute('CREATE TEMP TABLE e (id int PRIMARY KEY, meta jsonb)')
+    return 'e'
+
+
+def mixed_events(n):
+    """Small events, with a burst of 500 events carrying 20 kB of JSON."""
+    for i in range(n):
+        meta = '{"big": "%s"}' % ('x' * 20000) if 1000 <= i < 1500 else '{}'
+        yield (i, meta)
+
+
+@pytest.mark.parametrize('function', ['execute_values', 'execute_batch'])
+def test_adaptive_paging_of_mixed_size_events(conn, events_table, function):
+    sql = {
+        'execute_values': 'INSERT INTO e VALUES %s',
+        'execute_batch': 'INSERT INTO e VALUES (%s, %s)'
+    }[function]
+    statements = {}
+    for name, kwargs in [('fixed', {}),
+                         ('adaptive', {
+                             'pager': extras.AdaptivePager(
+                                 page_bytes=8192, max_bytes=1 << 19)
+                         })]:
+        with conn.cursor(cursor_factory=CountingCursor) as cur:
+            cur.execute('TRUNCATE e')
+            cur.statements.clear()
+            getattr(extras, function)(cur, sql, mixed_events(5000), **kwargs)
+            statements[name] = cur.statements
+        with conn.cursor() as cur:
+            cur.execute('SELECT count(*), sum(length(meta::text)) FROM e')
+            assert cur.fetchone() == (5000, 500 * 20011 + 4500 * 2)
+        print(f'{function} {name}: {len(statements[name])} statements, '
+              f'max {max(statements[name])} bytes')
+
+    pager = kwargs['pager']
+    assert max(statements['adaptive']) <= (1 << 19) + 20100
+    assert max(statements['fixed']) > 2 * max(statements['adaptive'])
+    assert len(statements['adaptive']) < len(statements['fixed'])
+    assert pager.total_rows == 5000
+    assert pager.total_pages == len(statements['adaptive'])
+    assert all(rows and nbytes and seconds > 0
+               for rows, nbytes, seconds in pager.pages)
+
+
+EDGE_VALUES = [
+    'plain', "it's", "''", '', 'back\\slash', 'new\nline', 'tab\t',
+    'ünïcödé ✓', '{"key": "it\'s \\"quoted\\""}', None, 0, -1, 2**70, 1.5,
+    True, datetime(2018, 1, 30, 12, 30, 1, 123), datetime(2018, 1, 30),
+    datetime(2018, 1, 30, tzinfo=timezone.utc), date(2018, 1, 30),
+    Decimal('-1.50'), b'\x00\x01'
+]
+
+
+def edge_rows():
+    """Rows of every edge value in every column, after a typical value."""
+    n = len(EDGE_VALUES)
+    return [tuple(EDGE_VALUES[(i + j) % n] for j in range(4))
+            for i in range(n)] + [('a', datetime(2018, 1, 1), 1, None)] * 3
+
+
+def event_rows(n):
+    """Rows of the ten column event schema, with JSON serialized."""
+    for i in range(n):
+        yield (
+            f'{i:08d}-7f3a-4c1e-9b2d-5e8f1a2b3c4d',
+            f'2018-01-30T12:{i // 60 % 60:02d}:{i % 60:02d}.{i % 1000:03d}Z',
+            'page_view', '1', "Tim's App", '2.0.1', f'user{i % 300}',
+            'Ümit O\'Brien', json.dumps({'path': f'/items/{i}', 'n': i}),
+            json.dumps({'sub': f'user{i % 300}', 'scope': ['read']}))
+
+
+def mogrified(cur, rows):
+    return [cur.mogrify('(' + ','.join(['%s'] * len(row)) + ')', row)
+            for row in rows]
+
+
+@pytest.mark.parametrize('standard_strings', ['on', 'off'])
+def test_encoder_matches_mogrify(conn, standard_strings):
+    with conn.cursor() as cur:
+        cur.execute(
+            f'SET standard_conforming_strings = {standard_strings}')
+        for rows in [edge_rows(), list(event_rows(1000)),
+                     [(v, ) for v in EDGE_VALUES]]:
+            for chunk_size in [1, 7, 1000]:
+                encoder = extras.RowEncoder(cur, chunk_size=chunk_size)
+                assert list(encoder.encode(rows)) == mogrified(cur, rows)
+
+
+def test_encoder_errors(conn):
+    with conn.cursor() as cur:
+        with pytest.raises(ValueError, match='NUL'):
+            list(extras.RowEncoder(cur).encode([('a', ), ('b\x00', )]))
+        with pytest.raises(ValueError, match='same number'):
+            list(extras.RowEncoder(cur).encode([('a', 1), ('b', )]))
+
+
+def test_execute_values_with_encoder(conn):
+    statements = {}
+    for name, encoder in [('mogrify', None), ('encoder', True)]:
+        with conn.cursor(cursor_factory=CountingCursor) as cur:
+            cur.execute('TRUNCATE t')
+            cur.statements.clear()
+            extras.execute_values(
+                cur, 'INSERT INTO t VALUES %s', rows(1000),
+                encoder=encoder and extras.RowEncoder(cur))
+            extras.execute_values_stream(
+                cur, 'INSERT INTO t VALUES %s',
+                ((i + 1000, data) for i, data in rows(1000, 20)),
+                page_bytes=1000, encoder=encoder and extras.RowEncoder(cur))
+            statements[name] = cur.statements
+        assert stored(conn)[999:1001] == [(999, '0000000999'),
+                                          (1000, '0' * 20)]
+    assert statements['encoder'] == statements['mogrify']
+
+
+def test_encoder_speedup(conn):
+    events = list(event_rows(10000))
+    with conn.cursor() as cur:
+        encoders = [
+            ('mogrify', lambda: mogrified(cur, events)),
+            ('encoder', lambda: list(extras.RowEncoder(cur).encode(events)))
+        ]
+        outputs = [encode() for _, encode in encoders]
+        timings = {}
+        for name, encode in encoders:
+            timings[name] = min(timeit.repeat(encode, number=1, repeat=5))
+            print(f'{name}: {timings[name] * 1000:.1f} ms for 10k rows')
+    # Timings depend on the machine, only reported:
+    print(f'speedup {timings["mogrify"] / timings["encoder"]:.1f}x')
+    assert outputs[0] == outputs[1]
@@ -0,0 +1,288 @@
+import random
+import threading
+import time
+
+import psycopg2
+import pytest
+
+import vendored
+
+pool = vendored.load('pool')
+
+
+def select_one(conn):
+    with conn, conn.cursor() as cur:
+        cur.execute('SELECT 1')
+        return cur.fetchone()[0]
+
+
+def test_wait_for_connection_to_be_put_back(dsn):
+    p = pool.ThreadedConnectionPool(1, 1, dsn)
+    conn = p.getconn()
+    threading.Timer(0.2, p.putconn, [conn]).start()
+
+    start = time.monotonic()
+    assert p.getconn(timeout=5) is conn
+    assert time.monotonic() - start >= 0.15
+    p.closeall()
+
+
+def test_raise_when_wait_times_out(dsn):
+    p = pool.ThreadedConnectionPool(0, 1, dsn, timeout=0.1)
+    p.getconn()
+
+    start = time.monotonic()
+    with pytest.raises(pool.PoolError, match='exhausted'):
+        p.getconn()
+    assert 0.1 <= time.monotonic() - start < 1
+    with pytest.raises(pool.PoolError, match='exhausted'):
+        p.getconn(timeout=0)
+    p.closeall()
+
+
+def test_closeall_wakes_up_waiters(dsn):
+    p = pool.ThreadedConnectionPool(0, 1, dsn)
+    p.getconn()
+    errors = []
+
+    def wait():
+        try:
+            p.getconn(timeout=5)
+        except pool.PoolError as e:
+            errors.append(str(e))
+
+    waiter = threading.Thread(target=wait)
+    waiter.start()
+    time.sleep(0.1)
+    p.closeall()
+    waiter.join(1)
+    assert errors == ['connection pool is closed']
+
+
+def test_prewarm_connections_in_parallel(mocker, dsn):
+    connect = psycopg2.connect
+
+    def slow_connect(*args, **kwargs):
+        time.sleep(0.2)
+        return connect(*args, **kwargs)
+
+    mocker.patch.object(pool.psycopg2, 'connect', slow_connect)
+    start = time.monotonic()
+    p = pool.ThreadedConnectionPool(5, 10, dsn)
+    assert time.monotonic() - start < 0.6
+    assert len(p._pool) == 5
+    assert all(select_one(conn) == 1 for conn in p._pool)
+    p.closeall()
+
+
+def test_replace_dropped_connection_on_checkout(dsn, terminate):
+    p = pool.ThreadedConnectionPool(1, 1, dsn, check_idle=0)
+    conn = p.getconn()
+    p.putconn(conn)
+    terminate(conn)
+
+    new_conn = p.getconn()
+    assert new_conn is not conn and conn.closed
+    assert select_one(new_conn) == 1
+    p.closeall()
+
+
+def test_check_connections_without_holding_the_lock(mocker, dsn):
+    p = pool.ThreadedConnectionPool(2, 2, dsn, check_idle=0)
+    checking = threading.Event()
+    alive = p._alive
+
+    def slow_alive(conn):
+        checking.set()
+        time.sleep(0.5)  # a slow server round trip
+        return alive(conn)
+
+    mocker.patch.object(p, '_alive', side_effect=slow_alive)
+    first = []
+    t = threading.Thread(target=lambda: first.append(p.getconn()))
+    t.start()
+    assert checking.wait(5)
+
+    # Not blocked by the check, the other pooled connection is checked too:
+    mocker.patch.object(p, '_alive', side_effect=alive)
+    start = time.monotonic()
+    conn = p.getconn()
+    assert time.monotonic() - start < 0.25
+    t.join()
+    assert first[0] is not conn
+    assert p.stats()['open'] == 2
+    with pytest.raises(pool.PoolError, match='exhausted'):
+        p.getconn(timeout=0.1)
+    p.closeall()
+
+
+def test_check_connections_below_unusable_ones_without_the_lock(mocker,
+                                                                dsn):
+    p = pool.ThreadedConnectionPool(2, 2, dsn, check_idle=0)
+    stale, unusable = p.getconn(), p.getconn()
+    p.putconn(stale)
+    p.putconn(unusable)
+    unusable.close()
+    alive = p._alive
+
+    def unlocked_alive(conn):
+        assert not p._lock.locked()
+        return alive(conn)
+
+    mocker.patch.object(p, '_alive', side_effect=unlocked_alive)
+    assert p.getconn() is stale
+    assert p._alive.call_count == 1
+    assert p.stats()['open'] == 1
+    p.closeall()
+
+
+def test_replace_connection_failing_check_while_waiting(dsn, terminate):
+    p = pool.ThreadedConnectionPool(1, 1, dsn, check_idle=0)
+    conn = p.getconn()
+    p.putconn(conn)
+    terminate(conn)
+
+    threads = [threading.Thread(target=lambda: p.putconn(p.getconn()))
+               for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert p.stats()['connections_created'] == 2
+    assert select_one(p.getconn()) == 1
+    p.closeall()
+
+
+@pytest.mark.parametrize('option', ['max_lifetime', 'max_idle'])
+def test_retire_old_connections(dsn, option):
+    p = pool.ThreadedConnectionPool(1, 1, dsn, **{option: 0.1})
+    conn = p.getconn()
+    p.putconn(conn)
+    assert p.getconn() is conn  # still fresh
+    p.putconn(conn)
+
+    time.sleep(0.15)
+    new_conn = p.getconn()
+    assert new_conn is not conn and conn.closed
+    p.closeall()
+
+
+def test_stress_64_threads(dsn):
+    threads_n, iterations, maxconn = 64, 50, 8
+    p = pool.ThreadedConnectionPool(
+        4, maxconn, dsn, timeout=30, check_idle=1, max_lifetime=0.5)
+    lock = threading.Lock()
+    checked_out = [0]
+    max_checked_out = [0]
+    waits = []
+    errors = []
+
+    def work():
+        try:
+            for _ in range(iterations):
+                start = time.monotonic()
+                conn = p.getconn()
+                with lock:
+                    waits.append(time.monotonic() - start)
+                    checked_out[0] += 1
+                    max_checked_out[0] = max(max_checked_out[0],
+                                             checked_out[0])
+                assert select_one(conn) == 1
+                time.sleep(random.random() * 0.002)
+                with lock:
+                    checked_out[0] -= 1
+                p.putconn(conn)
+        except Exception as e:
+            errors.append(e)
+
+    start = time.monotonic()
+    threads = [threading.Thread(target=work) for _ in range(threads_n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.monotonic() - start
+
+    waits.sort()
+    print(f'{threads_n * iterations} checkouts in {elapsed:.2f}s, '
+          f'wait p50 {waits[len(waits) // 2] * 1000:.1f}ms, '
+          f'max {waits[-1] * 1000:.1f}ms')
+    assert errors == []
+    assert len(waits) == threads_n * iterations
+    assert max_checked_out[0] <= maxconn
+    assert len(p._used) == 0 and len(p._pool) <= maxconn
+
+    stats = p.stats()
+    print(stats)
+    assert stats['checkouts'] == threads_n * iterations
+    assert stats['failed_checkouts'] == 0
+    assert stats['max_in_use'] == stats['max_open'] == maxconn
+    assert (stats['connections_created'] - stats['connections_closed'] ==
+            stats['open'] == len(p._pool))
+    p.closeall()
+
+
+def test_stats_and_callback(dsn):
+    events = []
+    p = pool.ThreadedConnectionPool(
+        1, 2, dsn, timeout=0.05,
+        callback=lambda event, value: events.append(event))
+    conn = p.getconn('key')
+    assert p.getconn('key') is conn  # not another checkout
+    extra = p.getconn()
+    with pytest.raises(pool.PoolError):
+        p.getconn()
+    time.sleep(0.01)
+    p.putconn(extra)
+    p.putconn(conn)  # closed, as minconn connections are already idle
+
+    stats = p.stats()
+    assert events == [
+        'connect', 'checkout', 'connect', 'checkout', 'checkout_failed',
+        'checkin', 'checkin', 'close'
+    ]
+    assert {k: stats[k] for k in [
+        'checkouts', 'failed_checkouts', 'connections_created',
+        'connections_closed', 'in_use', 'max_in_use', 'open', 'max_open'
+    ]} == {
+        'checkouts': 2,
+        'failed_checkouts': 1,
+        'connections_created': 2,
+        'connections_closed': 1,
+        'in_use': 0,
+        'max_in_use': 2,
+        'open': 1,
+        'max_open': 2
+    }
+    assert 1 <= stats['mean_open'] <= 2
+    assert 0 < stats['mean_in_use'] < 2
+    assert stats['wait_time']['count'] == 2
+    assert stats['hold_time']['count'] == 2
+    assert stats['hold_time']['max'] >= 0.06
+    assert sum(n for _, n in stats['hold_time']['buckets']) == 2
+    p.closeall()
+
+
+def test_instrumentation_overhead(dsn):
+    n = 20000
+    p = pool.ThreadedConnectionPool(1, 1, dsn)
+    start = time.perf_counter()
+    for _ in range(n):
+        p.putconn(p.getconn())
+    pair_us = (time.perf_counter() - start) / n * 1e6
+    p.closeall()
+
+    # Bookkeeping done on the getconn + putconn fast path:
+    stats = pool.PoolStats()
+    start = time.perf_counter()
+    for _ in range(n):
+        stats.checkouts += 1
+        stats.wait_time.add(0.0001)
+        stats.resize(1, 1)
+        stats.hold_time.add(0.001)
+        stats.resize(0, 1)
+    stats_us = (time.perf_counter() - start) / n * 1e6
+
+    # Timings depend on the machine, only reported:
+    print(f'getconn + putconn {pair_us:.1f}us, of which statistics '
+          f'{stats_us:.1f}us')
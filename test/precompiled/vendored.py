@@ -0,0 +1,19 @@
+"""
+Load the pure Python modules of the bundled psycopg2 for testing. The bundled
+C extension is built for the Lambda runtime, so the modules run on top of the
+locally installed psycopg2 instead.
+"""
+import importlib.util
+import os
+
+PSYCOPG2_PATH = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)), '..', '..', 'precompiled',
+    'psycopg2')
+
+
+def load(name):
+    spec = importlib.util.spec_from_file_location(
+        'vendored_' + name, os.path.join(PSYCOPG2_PATH, name + '.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
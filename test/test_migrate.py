@@ -0,0 +1,234 @@
+from datetime import date
+
+import pytest
+
+import migrate
+
+FIRST = """
+-- Not part of the migration
+-- migrate:up
+CREATE TABLE {table} (id int);
+-- migrate:down
+DROP TABLE {table};
+"""
+
+SECOND = """
+-- migrate:no-transaction
+-- migrate:up
+CREATE INDEX CONCURRENTLY IF NOT EXISTS t_id ON {table} (id);
+-- A comment with a semicolon;
+ALTER TABLE {table} ADD COLUMN IF NOT EXISTS name text;
+-- migrate:down
+DROP INDEX CONCURRENTLY {schema}.t_id;
+ALTER TABLE {table} DROP COLUMN name;
+"""
+
+FAILING = """
+-- migrate:up
+ALTER TABLE {table} ADD COLUMN value int;
+SELECT 1 / 0;
+"""
+
+
+@pytest.fixture
+def migrations(tmpdir):
+    """Return a function writing migrations into a directory."""
+
+    def write(**files):
+        for file_name, source in files.items():
+            tmpdir.join(file_name).write(source)
+        return str(tmpdir)
+
+    return write
+
+
+def test_load(migrations):
+    path = migrations(**{
+        '0002_add_index.sql': SECOND,
+        '0001_create.sql': FIRST,
+        'README.md': 'not a migration'
+    })
+    first, second = migrate.load(path)
+    assert (first.version, first.name, first.transactional) == (
+        1, 'create', True)
+    assert first.up.strip() == 'CREATE TABLE {table} (id int);'
+    assert first.down.strip() == 'DROP TABLE {table};'
+    assert (second.version, second.name, second.transactional) == (
+        2, 'add_index', False)
+
+
+def test_load_invalid(migrations):
+    with pytest.raises(ValueError, match='No -- migrate:up section'):
+        migrate.load(migrations(**{'0001_empty.sql': '-- migrate:down\n'}))
+    with pytest.raises(ValueError, match='Duplicate migration versions'):
+        migrate.load(migrations(**{
+            '0001_empty.sql': FIRST,
+            '1_again.sql': FIRST
+        }))
+
+
+def test_project_migrations():
+    loaded = migrate.load()
+    assert [m.version for m in loaded] == list(range(1, len(loaded) + 1))
+    assert all(m.down.strip() for m in loaded)
+
+
+def test_split_statements():
+    sql = """
+    CREATE INDEX CONCURRENTLY t_id ON t (id);
+    -- Comments ending in a semicolon end statements too;
+    INSERT INTO t VALUES (';'); INSERT INTO t VALUES (1);
+    -- Nothing but a comment;
+    """
+    assert [s.strip() for s in migrate.split_statements(sql)] == [
+        'CREATE INDEX CONCURRENTLY t_id ON t (id)',
+        "INSERT INTO t VALUES (';'); INSERT INTO t VALUES (1)"
+    ]
+
+
+def columns(conn, table):
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT array_agg(attname::text ORDER BY attnum) FROM pg_attribute
+            WHERE attrelid = to_regclass(%s) AND attnum > 0
+            AND NOT attisdropped
+        """, [table])
+        return cur.fetchone()[0]
+
+
+def test_apply_status_and_rollback(schema, migrations):
+    conn, params = schema
+    loaded = migrate.load(migrations(**{
+        '0001_create.sql': FIRST,
+        '0002_add_index.sql': SECOND
+    }))
+
+    assert migrate.apply(conn, params, target=1, migrations=loaded) == \
+        loaded[:1]
+    assert columns(conn, params['table']) == ['id']
+    status = migrate.status(conn, params['schema'], loaded)
+    assert [(m.version, bool(applied_at)) for m, applied_at in status] == [
+        (1, True), (2, False)
+    ]
+
+    assert migrate.apply(conn, params, migrations=loaded) == loaded[1:]
+    assert migrate.apply(conn, params, migrations=loaded) == []
+    assert columns(conn, params['table']) == ['id', 'name']
+    assert all(applied_at for _, applied_at in
+               migrate.status(conn, params['schema'], loaded))
+
+    assert migrate.rollback(conn, params, migrations=loaded) == loaded[1:]
+    assert columns(conn, params['table']) == ['id']
+    assert migrate.rollback(conn, params, steps=5, migrations=loaded) == \
+        loaded[:1]
+    assert columns(conn, params['table']) is None
+    assert [applied_at for _, applied_at in
+            migrate.status(conn, params['schema'], loaded)] == [None, None]
+
+
+def test_failing_migration_is_rolled_back(schema, migrations):
+    conn, params = schema
+    loaded = migrate.load(migrations(**{
+        '0001_create.sql': FIRST,
+        '0002_fail.sql': FAILING
+    }))
+
+    with pytest.raises(Exception, match='division by zero'):
+        migrate.apply(conn, params, migrations=loaded)
+    assert columns(conn, params['table']) == ['id']
+    assert [bool(applied_at) for _, applied_at in
+            migrate.status(conn, params['schema'], loaded)] == [True, False]
+
+
+def test_partition_existing_events(schema):
+    conn, params = schema
+    table = params['table']
+    migrate.apply(conn, params, target=3)
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            INSERT INTO {table} (event_id, event_timestamp, event_type,
+              event_version, app_title, app_version, user_id, user_name)
+            SELECT 'event' || i, '2018-01-01'::timestamp + i * interval '1h',
+              'type', '1', 'app', '1', 'user', 'name'
+            FROM generate_series(1, 100) i
+        """)
+
+    assert [m.version for m in migrate.apply(conn, params)] == [4]
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            SELECT tableoid::regclass::text, count(*), max(id) FROM {table}
+            GROUP BY 1
+        """)
+        assert cur.fetchall() == [(table + '_default', 100, 100)]
+        cur.execute(f"""
+            INSERT INTO {table} (event_id, event_timestamp, event_type,
+              event_version, app_title, app_version, user_id, user_name)
+            VALUES ('event1', '2018-01-01 01:00', 'type', '1', 'app', '1',
+              'user', 'name')
+            ON CONFLICT (event_id, event_timestamp) DO NOTHING
+            RETURNING id
+        """)
+        assert cur.fetchall() == []
+
+    assert [m.version for m in migrate.rollback(conn, params)] == [4]
+    with conn.cursor() as cur:
+        cur.execute(f'SELECT count(*) FROM {table}')
+        assert cur.fetchone()[0] == 100
+        cur.execute(f"""
+            SELECT indexrelid::regclass::text FROM pg_index
+            WHERE indrelid = '{table}'::regclass ORDER BY 1
+        """)
+        schema_name = params['schema']
+        assert [r[0] for r in cur.fetchall()] == [
+            f'{schema_name}.event_id', f'{schema_name}.event_type',
+            f'{table}_pkey'
+        ]
+
+    migrate.rollback(conn, params, steps=3)
+    assert columns(conn, table) is None
+
+
+def test_create_partitions(schema):
+    conn, params = schema
+    table = params['table']
+    migrate.apply(conn, params)
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            INSERT INTO {table} (event_id, event_timestamp, event_type,
+              event_version, app_title, app_version, user_id, user_name)
+            SELECT 'event' || i, '2017-11-30'::timestamp + i * interval '1d',
+              'type', '1', 'app', '1', 'user', 'name'
+            FROM generate_series(1, 40) i
+        """)
+
+    def stored():
+        with conn.cursor() as cur:
+            cur.execute(f"""
+                SELECT tableoid::regclass::text, count(*) FROM {table}
+                GROUP BY 1 ORDER BY min(event_timestamp)
+            """)
+            return cur.fetchall()
+
+    # Regular runs create the current month and following ones:
+    assert migrate.create_partitions(conn, table, date(2018, 1, 24),
+                                     date(2018, 2, 1)) == [
+        table + '_y2018m01', table + '_y2018m02'
+    ]
+    assert stored() == [(table + '_default', 31), (table + '_y2018m01', 9)]
+
+    # Backfilling past months, existing partitions are left alone:
+    conn.autocommit = False
+    assert migrate.create_partitions(conn, table, date(2017, 11, 5),
+                                     date(2018, 1, 1)) == [
+        table + '_y2017m11', table + '_y2017m12', table + '_y2018m01'
+    ]
+    assert not conn.autocommit
+    assert stored() == [(table + '_y2017m12', 31), (table + '_y2018m01', 9)]
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            EXPLAIN SELECT count(*) FROM {table}
+            WHERE event_timestamp >= '2017-12-10'
+            AND event_timestamp < '2017-12-20'
+        """)
+        plan = '\n'.join(r[0] for r in cur.fetchall())
+    assert 'y2017m12' in plan and 'default' not in plan
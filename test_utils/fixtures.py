@@ -1,27 +1,71 @@
-from datetime import datetime, timedelta
+from datetime import datetime
+import json
 import os
+import sys
+import time
 import uuid
 
 import pytest
 
+# Root directory with the database migrations:
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+# Postgres connection string for tests that need a database, e.g.
+# postgresql://postgres@localhost/postgres. Such tests are skipped if unset.
+TEST_DB_URL = os.environ.get('TEST_DB_URL')
+
 os.environ['AWS_ACCESS_KEY_ID'] = 'xxx'
 os.environ['AWS_DEFAULT_REGION'] = 'eu-central-1'
 os.environ['AWS_SECRET_ACCESS_KEY'] = 'xxx'
 os.environ['SESSION'] = 'xxx'
 
 
+class SimulatedClock:
+    """
+    Clock function whose time only advances by setting `now` or calling
+    `sleep`, e.g. for `lambda_context`.
+    """
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class MockSQSMessage:
+    """
+    Mock SQS message, with the given event wrapped in an SNS notification
+    envelope as its body, if any.
+    """
+
+    def __init__(self, event=None):
+        self.message_id = event['event_id'] if event else str(uuid.uuid4())
+        self.receipt_handle = str(uuid.uuid4())
+        if event is not None:
+            self.body = json.dumps({'Message': json.dumps(event)})
+
+
 @pytest.fixture
 def lambda_context():
     """
     Return a mock Lambda Context instance to be used in manual invocation.
+    Create contexts with other timeouts or a SimulatedClock with
+    `type(lambda_context)(timeout, clock)`.
     """
 
     class Context(object):
-        def __init__(self, timeout=3):
-            self.target = datetime.now() + timedelta(seconds=timeout)
+        def __init__(self, timeout=3, clock=time.monotonic):
+            self.clock = clock
+            self.deadline = clock() + timeout
+            self.invoked_function_arn = (
+                'arn:aws:lambda:eu-central-1:123456789012:function:test')
 
         def get_remaining_time_in_millis(self):
-            return max((self.target - datetime.now()).seconds, 0) * 1000
+            return int(max(self.deadline - self.clock(), 0) * 1000)
 
     return Context(300)
 
@@ -43,3 +87,68 @@ def event():
         'meta': {},
         'user_payload': {}
     }
+
+
+@pytest.fixture
+def schema():
+    """
+    Create a throwaway schema in the test database. Return a connection and
+    the schema's migration parameters.
+    """
+    if not TEST_DB_URL:
+        pytest.skip('TEST_DB_URL not set')
+
+    import psycopg2
+    schema = 'test_' + uuid.uuid4().hex[:8]
+    conn = psycopg2.connect(TEST_DB_URL)
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute(f'CREATE SCHEMA {schema}')
+    user = conn.get_dsn_parameters()['user']
+
+    yield conn, {
+        'schema': schema,
+        'table': schema + '.events',
+        'consumer': user,
+        'producer': user
+    }
+
+    conn.rollback()
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute(f'DROP SCHEMA {schema} CASCADE')
+    conn.close()
+
+
+@pytest.fixture
+def db(schema):
+    """
+    Migrate a throwaway schema of the test database. Return the database URL
+    and the events table name.
+    """
+    import migrate
+    conn, params = schema
+    migrate.apply(conn, params)
+    return TEST_DB_URL, params['table']
+
+
+@pytest.fixture
+def terminate():
+    """
+    Return a function that has the server drop a connection, like a database
+    restart would.
+    """
+    if not TEST_DB_URL:
+        pytest.skip('TEST_DB_URL not set')
+
+    import psycopg2
+    admin_conn = psycopg2.connect(TEST_DB_URL)
+    admin_conn.autocommit = True
+
+    def terminate(conn):
+        with admin_conn.cursor() as cur:
+            cur.execute('SELECT pg_terminate_backend(%s)',
+                        [conn.get_backend_pid()])
+
+    yield terminate
+    admin_conn.close()